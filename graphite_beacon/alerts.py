@@ -1,25 +1,36 @@
 """Implement alerts."""
 
-from tornado import ioloop, httpclient as hc, gen, escape
+from tornado import gen, escape
 
 from . import _compat as _
-from .graphite import GraphiteRecord
+from .graphite import GraphiteRecord, GraphiteStream, GraphiteWindow
+from .store import HistoryMap, StateMap, TargetStore
 from .utils import (
     HISTORICAL,
     LOGICAL_OPERATORS,
+    compile_rule,
+    compile_rule_array,
     convert_to_format,
     interval_to_graphite,
     parse_interval,
     parse_rule,
 )
+import hashlib
+import json
 import math
-from collections import deque, defaultdict
-from itertools import islice
+import time
 import urllib
 import logging
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 LOGGER = logging.getLogger('graphite-beacon')
 METHODS = "average", "last_value", "sum", "min", "max"
+# Steps re-requested by incremental fetches (the latest points may be incomplete)
+INCREMENTAL_OVERLAP = 2
 LEVELS = {
     'critical': 0,
     'warning': 10,
@@ -27,18 +38,6 @@ LEVELS = {
 }
 
 
-class sliceable_deque(deque):
-
-    """Deque with slices support."""
-
-    def __getitem__(self, index):
-        """Support slices."""
-        try:
-            return deque.__getitem__(self, index)
-        except TypeError:
-            return type(self)(islice(self, index.start, index.stop, index.step))
-
-
 class AlertFabric(type):
 
     """Register alert's classes and produce an alert by source."""
@@ -70,7 +69,8 @@ class BaseAlert(_.with_metaclass(AlertFabric)):
         """Initialize alert."""
         self.reactor = reactor
         self.options = options
-        self.client = hc.AsyncHTTPClient()
+        self.client = reactor.client
+        self.fingerprint = self.get_fingerprint(reactor, dict(options, source=self.source))
 
         try:
             self.configure(**options)
@@ -79,11 +79,24 @@ class BaseAlert(_.with_metaclass(AlertFabric)):
             raise ValueError("Invalid alert configuration: %s" % e)
 
         self.waiting = False
-        self.state = {None: "normal", "waiting": "normal", "loading": "normal"}
-        self.history = defaultdict(lambda: sliceable_deque([], self.history_size))
+        self.store = TargetStore(self.history_size)
+        self.state = StateMap(
+            self.store, {None: "normal", "waiting": "normal", "loading": "normal"})
+        self.history = HistoryMap(self.store)
+        self.last_seen = {}
 
         LOGGER.info("Alert '%s': has inited", self)
 
+    @staticmethod
+    def get_fingerprint(reactor, options):
+        """Get a fingerprint of the alert's options and the reactor's defaults."""
+        options = dict(options, source=options.get('source', 'graphite'))
+        defaults = dict(
+            (name, value) for name, value in reactor.options.items()
+            if name != 'alerts' and not isinstance(value, (dict, list)))
+        config = json.dumps([options, defaults], sort_keys=True, default=str)
+        return hashlib.md5(config.encode('utf-8')).hexdigest()
+
     def __hash__(self):
         """Provide alert's hash."""
         return hash(self.name) ^ hash(self.source)
@@ -131,17 +144,30 @@ class BaseAlert(_.with_metaclass(AlertFabric)):
         self.history_size = parse_interval(self.history_size)
         self.history_size = int(math.ceil(self.history_size / interval))
 
+        self.historical = False
+        for rule in self.rules:
+            rule['evaluate'] = compile_rule(rule, self.history_size)
+            rule['evaluate_array'] = compile_rule_array(rule)
+            self.historical = self.historical or any(
+                isinstance(expr, dict) and expr['value'] == HISTORICAL for expr in rule['exprs'])
+
         self.no_data = options.get('no_data', self.reactor.options['no_data'])
         self.loading_error = options.get('loading_error', self.reactor.options['loading_error'])
 
         if self.reactor.options.get('debug'):
-            self.callback = ioloop.PeriodicCallback(self.load, 5000)
+            self.period = 5000
         else:
-            self.callback = ioloop.PeriodicCallback(self.load, interval)
+            self.period = interval
 
         # Notification channel override.
         self.channel = options.get('channel', None)
 
+        self.target_ttl = parse_interval(
+            options.get('target_ttl', self.reactor.options['target_ttl'])) / 1000.0
+        self.max_targets = options.get('max_targets', self.reactor.options['max_targets'])
+        self.target_disappeared = options.get(
+            'target_disappeared', self.reactor.options['target_disappeared'])
+
     def convert(self, value):
         """Convert self value."""
         return convert_to_format(value, self._format)
@@ -151,52 +177,150 @@ class BaseAlert(_.with_metaclass(AlertFabric)):
 
         It will repeat notification if a metric is still failed.
         """
-        for target in self.state:
-            self.state[target] = "normal"
+        self.state.fill("normal")
 
     def start(self):
         """Start checking."""
-        self.callback.start()
-        self.load()
+        self.reactor.scheduler.add(self, self.period)
         return self
 
     def stop(self):
         """Stop checking."""
-        self.callback.stop()
+        self.reactor.scheduler.remove(self)
         return self
 
     def check(self, records):
         """Check current value."""
+        now = time.time()
+        for _value, target in records:
+            if target in self.last_seen:
+                self.last_seen[target] = now
+
+        self.evict(now)
+        self.check_records(self.admit(records, now))
+
+    def admit(self, records, now):
+        """Start tracking the new targets of the records while there are less than
+        `max_targets`. Returns the records of the tracked targets."""
+        admitted, ignored = [], set()
+        for record in records:
+            target = record[1]
+            if target not in self.last_seen:
+                if self.max_targets and len(self.last_seen) >= self.max_targets:
+                    ignored.add(target)
+                    continue
+                self.last_seen[target] = now
+            admitted.append(record)
+
+        if ignored:
+            LOGGER.warn('%s: too many targets (max_targets=%d), ignore %d new targets',
+                        self.name, self.max_targets, len(ignored))
+        return admitted
+
+    def check_records(self, records):
+        threshold = self.reactor.options['vectorize_threshold']
+        if numpy is not None and threshold and len(records) >= threshold:
+            targets = [target for _value, target in records]
+            # Repeated targets depend on each other's history, check them one by one
+            if len(set(targets)) == len(targets):
+                return self.check_vectorized(records)
+
         for value, target in records:
             LOGGER.info("%s [%s]: %s", self.name, target, value)
             if value is None:
                 self.notify(self.no_data, value, target)
                 continue
+            history = self.history[target]
             for rule in self.rules:
-                if self.evaluate_rule(rule, value, target):
+                if rule['evaluate'](value, history):
                     self.notify(rule['level'], value, target, rule=rule)
                     break
             else:
                 self.notify('normal', value, target, rule=rule)
 
-            self.history[target].append(value)
+            history.append(value)
 
-    def evaluate_rule(self, rule, value, target):
-        """Calculate the value."""
-        def evaluate(expr):
-            if expr in LOGICAL_OPERATORS.values():
-                return expr
-            rvalue = self.get_value_for_expr(expr, target)
-            if rvalue is None:
-                return False  # ignore this result
-            return expr['op'](value, rvalue)
+    def check_vectorized(self, records):
+        """Check all the targets at once.
 
-        evaluated = [evaluate(expr) for expr in rule['exprs']]
-        while len(evaluated) > 1:
-            lhs, logical_op, rhs = (evaluated.pop(0) for _ in range(3))
-            evaluated.insert(0, logical_op(lhs, rhs))
+        Every rule is evaluated as a NumPy mask over the values of all targets; only the targets
+        whose level has changed are notified.
+        """
+        LOGGER.info("%s: check %d targets", self.name, len(records))
+        targets = [target for _value, target in records]
+        raw = [value for value, _target in records]
+        values = numpy.array([0 if value is None else value for value in raw], dtype=float)
+        missing = numpy.array([value is None for value in raw], dtype=bool)
+        store = self.store
+        slots = numpy.array([store.intern(target) for target in targets], dtype=int)
+
+        averages = full = None
+        if self.historical:
+            counts = numpy.frombuffer(store.counts, dtype='l')[slots]
+            sums = numpy.frombuffer(store.sums, dtype=float)[slots]
+            full = counts >= self.history_size
+            averages = numpy.where(counts > 0, sums / numpy.maximum(counts, 1), 0)
+
+        # Index of the first matched rule, then "normal" and "no data"
+        matched = numpy.empty(len(values), dtype=int)
+        matched.fill(len(self.rules))
+        for num, rule in reversed(list(enumerate(self.rules))):
+            matched[rule['evaluate_array'](values, averages, full)] = num
+        matched[missing] = len(self.rules) + 1
+
+        levels = numpy.array(
+            [rule['level'] for rule in self.rules] + ['normal', self.no_data], dtype=object)
+        levels = levels[matched]
+        # Unknown levels (-1) are mapped to the last name, None
+        names = numpy.array(store.level_names + [None], dtype=object)
+        previous = names[numpy.frombuffer(store.levels, dtype='b')[slots]]
+        rules = self.rules + [self.rules[-1], None]
+
+        values = values.tolist()
+        for num in numpy.flatnonzero(levels != previous):
+            value = None if missing[num] else values[num]
+            self.notify(levels[num], value, targets[num], rule=rules[matched[num]])
+
+        for num in numpy.flatnonzero(~missing):
+            store.views[slots[num]].append(values[num])
+
+    def evict(self, now):
+        """Forget the targets which haven't been seen for `target_ttl`.
+
+        The least recently seen targets over `max_targets` (e.g. restored from a snapshot) are
+        forgotten too. Targets seen at `now` are always kept.
+        """
+        stale = set()
+        if self.target_ttl:
+            deadline = now - self.target_ttl
+            stale.update(target for target, seen in self.last_seen.items() if seen < deadline)
+
+        extra = len(self.last_seen) - len(stale) - (self.max_targets or len(self.last_seen))
+        if extra > 0:
+            unseen = sorted(
+                (target for target, seen in self.last_seen.items()
+                 if seen < now and target not in stale), key=self.last_seen.get)[:extra]
+            if unseen:
+                LOGGER.warn('%s: too many targets, forget %d of them', self.name, len(unseen))
+            stale.update(unseen)
+
+        for target in stale:
+            # Not deduplicated by the target's state: the target goes away whatever its level
+            if self.target_disappeared:
+                self.reactor.notify(self.target_disappeared, self, 'disappeared', target=target,
+                                    ntype='disappeared')
+            self.forget(target)
+
+    def forget(self, target):
+        """Drop everything known about the target."""
+        LOGGER.info('%s [%s]: forget the target', self.name, target)
+        self.last_seen.pop(target, None)
+        self.history.pop(target, None)
+        self.state.pop(target, None)
 
-        return evaluated[0]
+    def evaluate_rule(self, rule, value, target):
+        """Calculate the value."""
+        return rule['evaluate'](value, self.history[target])
 
     def get_value_for_expr(self, expr, target):
         """I have no idea."""
@@ -207,7 +331,7 @@ class BaseAlert(_.with_metaclass(AlertFabric)):
             history = self.history[target]
             if len(history) < self.history_size:
                 return None
-            rvalue = sum(history) / float(len(history))
+            rvalue = history.average
 
         rvalue = expr['mod'](rvalue)
         return rvalue
@@ -250,10 +374,16 @@ class GraphiteAlert(BaseAlert):
         self.auth_username = self.reactor.options.get('auth_username')
         self.auth_password = self.reactor.options.get('auth_password')
 
-        self.url = self._graphite_url(
-            self.query, graphite_url=self.reactor.options.get('graphite_url'), raw_data=True)
+        self.graphite_url = self.reactor.options.get('graphite_url')
+        self.url = self._graphite_url(self.query, graphite_url=self.graphite_url, raw_data=True)
         LOGGER.debug('%s: url = %s', self.name, self.url)
 
+        # Incremental alerts keep the points of their windows and fetch only the missing tail
+        self.incremental = options.get('incremental', self.reactor.options['incremental'])
+        self.windows = {}
+        self.generation = 0
+        self.resync = False
+
     @gen.coroutine
     def load(self):
         """Load data from Graphite."""
@@ -263,21 +393,12 @@ class GraphiteAlert(BaseAlert):
         else:
             self.waiting = True
             try:
-                response = yield self.client.fetch(
-                    self.url,
-                    auth_username=self.auth_username,
-                    auth_password=self.auth_password,
-                    request_timeout=self.request_timeout,
-                    connect_timeout=self.connect_timeout
-                )
-                records = (
-                    GraphiteRecord(line.decode('utf-8'), self.default_nan_value, self.ignore_nan)
-                    for line in response.buffer)
+                records = yield self.fetch()
                 data = [
                     (None if record.empty else getattr(record, self.method), record.target)
                     for record in records]
                 if len(data) == 0:
-                    LOGGER.error("No data in response form Graphite: %r", response)
+                    LOGGER.error("No data in response form Graphite: %s", self.url)
                     raise ValueError('No data')
                 self.check(data)
                 self.notify('normal', 'Metrics are loaded', target='loading', ntype='common')
@@ -286,6 +407,97 @@ class GraphiteAlert(BaseAlert):
                     self.loading_error, 'Loading error: %s' % e, target='loading', ntype='common')
             self.waiting = False
 
+    @gen.coroutine
+    def fetch(self):
+        """Fetch Graphite records, merging the request with other alerts when enabled."""
+        time_window = self.fetch_window()
+        if not self.incremental:
+            # Alerts with the same query share the request and its records
+            url = self._graphite_url(
+                self.query, graphite_url=self.graphite_url, raw_data=True,
+                time_window=time_window)
+            key = (url, self.auth_username, self.auth_password, self.default_nan_value,
+                   self.ignore_nan)
+            records = yield self.reactor.cache.fetch(key, lambda: self._load(time_window))
+            raise gen.Return(records)
+
+        self.generation += 1
+        self.resync = False
+        records = yield self._load(time_window)
+        if self.resync and time_window != self.time_window:
+            # The kept points can't be merged with the tail, load the whole window again
+            LOGGER.info('%s: Graphite has changed the step, reload the window', self.name)
+            self.windows.clear()
+            self.generation += 1
+            records = yield self._load(self.time_window)
+
+        for target, window in list(self.windows.items()):
+            if window.generation != self.generation:
+                del self.windows[target]
+        raise gen.Return(records)
+
+    def _load(self, time_window):
+        if self.reactor.batcher.enabled:
+            return self.reactor.batcher.fetch(self, time_window)
+        return self._fetch(time_window)
+
+    def forget(self, target):
+        super(GraphiteAlert, self).forget(target)
+        self.windows.pop(target, None)
+
+    def fetch_window(self):
+        """Get the time window to request.
+
+        Incremental alerts request only the points after the ones they already have.
+        """
+        if not self.incremental or not self.windows:
+            return self.time_window
+
+        windows = self.windows.values()
+        step = max(window.step for window in windows)
+        seconds = time.time() - min(window.end_time for window in windows)
+        seconds = int(math.ceil(seconds / float(step)) + INCREMENTAL_OVERLAP) * step
+        if seconds * 1000 >= parse_interval(self.time_window):
+            return self.time_window
+        return interval_to_graphite(str(seconds))
+
+    @gen.coroutine
+    def _fetch(self, time_window):
+        records = []
+        stream = GraphiteStream(lambda line: records.append(self.parse(line)))
+        yield self.client.fetch(
+            self._graphite_url(
+                self.query, graphite_url=self.graphite_url, raw_data=True,
+                time_window=time_window),
+            auth_username=self.auth_username,
+            auth_password=self.auth_password,
+            request_timeout=self.request_timeout,
+            connect_timeout=self.connect_timeout,
+            streaming_callback=stream.feed,
+            header_callback=stream.header,
+        )
+        stream.close()
+        raise gen.Return(records)
+
+    def parse(self, line):
+        """Parse a rawData line into a record."""
+        line = line.decode('utf-8')
+        if not self.incremental:
+            return GraphiteRecord(line, self.default_nan_value, self.ignore_nan)
+
+        target, start_time, _end_time, step, data = GraphiteRecord.split(line)
+        window = self.windows.get(target)
+        if window is not None and window.step != step:
+            # E.g. the whole window was served from a coarser archive than the tail
+            self.resync = True
+        if window is None or window.step != step:
+            size = int(math.ceil(parse_interval(self.time_window) / 1000.0 / step))
+            window = self.windows[target] = GraphiteWindow(step, size)
+        window.update(start_time, data)
+        window.generation = self.generation
+        return GraphiteRecord.from_window(
+            target, window, self.default_nan_value, self.ignore_nan)
+
     def get_graph_url(self, target, graphite_url=None):
         """Get Graphite URL."""
         return self._graphite_url(target, graphite_url=graphite_url, raw_data=False)
@@ -306,13 +518,14 @@ class GraphiteAlert(BaseAlert):
             base=graphite_url, args=urllib.urlencode(args),
         )
 
-    def _graphite_url(self, query, raw_data=False, graphite_url=None):
+    def _graphite_url(self, query, raw_data=False, graphite_url=None, time_window=None):
         """Build Graphite URL."""
         query = escape.url_escape(query)
         graphite_url = graphite_url or self.reactor.options.get('public_graphite_url')
 
         url = "{base}/render/?target={query}&from=-{time_window}&until=-{until}".format(
-            base=graphite_url, query=query, time_window=self.time_window, until=self.until
+            base=graphite_url, query=query, time_window=time_window or self.time_window,
+            until=self.until
         )
         if raw_data:
             url = "{0}&rawData=true".format(url)
@@ -4,17 +4,23 @@ import boomtrain.logging
 from tornado.options import define, options
 
 from .core import Reactor
+from .shard import Supervisor
 
 
 define('config', default=Reactor.defaults['config'], help='Path to an configuration file (YAML)')
 define('pidfile', default=Reactor.defaults['pidfile'], help='Set pid file')
 define('graphite_url', default=Reactor.defaults['graphite_url'], help='Graphite URL')
+define('workers', default=0, help='Check alerts in this number of worker processes')
 
 
 def run():
     boomtrain.logging.setup()
     options.parse_command_line()
 
+    workers = options.workers
+    if workers:
+        return Supervisor(workers, **options.as_dict()).start()
+
     r = Reactor(**options.as_dict())
 
     signal.signal(signal.SIGTERM, r.stop)
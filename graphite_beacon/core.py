@@ -6,6 +6,12 @@ import logging
 from tornado import ioloop
 
 from .alerts import BaseAlert
+from .dispatch import Digest, Dispatcher
+from .events import Event
+from .fetch import FetchCache, GraphiteBatcher, HTTPPool
+from .scheduler import Scheduler
+from .snapshot import Snapshot
+from .spool import Spool
 from .utils import parse_interval
 from .handlers import registry
 
@@ -27,6 +33,10 @@ class Reactor(object):
     defaults = {
         'auth_password': None,
         'auth_username': None,
+        'backend_concurrency': 0,
+        'batch_size': 0,
+        'batch_window': '0second',
+        'cache_ttl': '0second',
         'config': 'config.json',
         'critical_handlers': ['log', 'smtp'],
         'debug': False,
@@ -34,11 +44,19 @@ class Reactor(object):
         'graphite_url': 'http://localhost',
         'graphite_error_level': 'critical',
         'history_size': '1day',
+        'http_client': 'simple',
+        'incremental': False,
         'interval': '10minute',
         'logging': 'info',
+        'max_clients': 10,
+        'max_targets': 0,
         'method': 'average',
         'no_data': 'critical',
         'normal_handlers': ['log', 'smtp'],
+        'notify_concurrency': 1,
+        'notify_overflow': 'drop_oldest',
+        'notify_queue_size': 1000,
+        'notify_timeout': '30second',
         'pidfile': None,
         'prefix': '[BEACON]',
         'public_graphite_url': None,
@@ -46,17 +64,38 @@ class Reactor(object):
         'request_timeout': 20.0,
         'connect_timeout': 20.0,
         'send_initial': False,
+        'snapshot': None,
+        'snapshot_interval': '1minute',
+        'spool': None,
+        'spool_backoff': '10second',
+        'spool_fsync': '1second',
+        'spool_retries': 5,
+        'target_disappeared': None,
+        'target_ttl': '0second',
         'until': '0second',
+        'vectorize_threshold': 1000,
         'warning_handlers': ['log', 'smtp'],
+        'digest': False,
+        'digest_window': '0second',
         'default_nan_value': 0,
         'ignore_nan': False,
         'loading_error': 'critical'
     }
 
-    def __init__(self, **options):
+    def __init__(self, shard=None, **options):
         self.alerts = set()
+        self.shard = shard
+        self.upstream = None
         self.loop = ioloop.IOLoop.instance()
         self.options = dict(self.defaults)
+        self.client = HTTPPool(self)
+        self.batcher = GraphiteBatcher(self)
+        self.cache = FetchCache(self)
+        self.dispatcher = Dispatcher(self)
+        self.digest = Digest(self)
+        self.scheduler = Scheduler()
+        self.spool = Spool(self)
+        self.snapshot = Snapshot(self)
         self.reinit(**options)
         self.callback = ioloop.PeriodicCallback(
             self.repeat, parse_interval(self.options['repeat_interval']))
@@ -74,24 +113,65 @@ class Reactor(object):
             self.options['public_graphite_url'] = self.options['graphite_url']
 
         LOGGER.setLevel(_get_numeric_log_level(self.options.get('logging', 'info')))
+        self.client.configure()
         registry.clean()
 
         self.handlers = {'warning': set(), 'critical': set(), 'normal': set()}
-        self.reinit_handlers('warning')
-        self.reinit_handlers('critical')
-        self.reinit_handlers('normal')
+        snapshot, spool = self.options['snapshot'], self.options['spool']
+        if self.is_worker:
+            # Workers pass their notifications to the supervisor
+            snapshot, spool = snapshot and '%s.%d' % (snapshot, self.shard.index), None
+        else:
+            self.reinit_handlers('warning')
+            self.reinit_handlers('critical')
+            self.reinit_handlers('normal')
+            if self.shard is not None:
+                snapshot = None
 
-        for alert in list(self.alerts):
-            alert.stop()
-            self.alerts.remove(alert)
+        self.reinit_alerts()
+
+        if self.snapshot.configure(snapshot):
+            self.snapshot.restore()
 
-        self.alerts = set(
-            BaseAlert.get(self, **opts).start() for opts in self.options.get('alerts', []))
+        if self.spool.open(spool):
+            self.spool.replay()
 
         LOGGER.debug('Loaded with options:')
         LOGGER.debug(json.dumps(self.options, indent=2))
         return self
 
+    def reinit_alerts(self):
+        """Rebuild the alerts whose configuration has changed.
+
+        Unchanged alerts keep running with their states and histories.
+        """
+        current = dict((alert.fingerprint, alert) for alert in self.alerts)
+        added, kept = [], set()
+        for opts in self.options.get('alerts', []):
+            alert = current.pop(BaseAlert.get_fingerprint(self, opts), None)
+            if alert is None:
+                added.append(opts)
+            else:
+                kept.add(alert)
+
+        # Removed alerts are stopped first, changed alerts are equal to their new versions
+        for alert in current.values():
+            alert.stop()
+
+        added = [BaseAlert.get(self, **opts) for opts in added]
+        self.alerts = kept | set(alert.start() if self.owns(alert) else alert for alert in added)
+        if current or added:
+            LOGGER.info('Alerts: %d kept, %d removed, %d added',
+                        len(kept), len(current), len(added))
+
+    @property
+    def is_worker(self):
+        return self.shard is not None and self.shard.index is not None
+
+    def owns(self, alert):
+        """Check whether the alert is checked by this process."""
+        return self.shard is None or self.shard.owns(alert.name)
+
     def include_config(self, config):
         LOGGER.info('Load configuration: %s' % config)
         if config:
@@ -112,6 +192,13 @@ class Reactor(object):
                 LOGGER.error('Handler "%s" did not init. Error: %s' % (name, e))
 
     def repeat(self):
+        depth = self.dispatcher.depth()
+        if any(depth.values()):
+            LOGGER.info('Queued notifications: %s', depth)
+        if self.dispatcher.stats:
+            LOGGER.info('Deliveries: %s', dict(self.dispatcher.stats))
+        if self.client.stats:
+            LOGGER.info('Backend requests: %s', dict(self.client.stats))
         LOGGER.info('Reset alerts')
         for alert in self.alerts:
             alert.reset()
@@ -126,6 +213,10 @@ class Reactor(object):
 
     def stop(self, *args):
         self.callback.stop()
+        self.scheduler.stop()
+        self.snapshot.save(wait=True)
+        self.snapshot.stop()
+        self.spool.close()
         self.loop.stop()
         if self.options.get('pidfile'):
             os.unlink(self.options.get('pidfile'))
@@ -139,8 +230,20 @@ class Reactor(object):
         if ntype is None:
             ntype = alert.source
 
-        for handler in self.handlers.get(level, []):
-            handler.notify(level, alert, value, target=target, ntype=ntype, rule=rule)
+        event = Event(level, alert, value, target, ntype, rule)
+        if self.upstream is not None:
+            return self.upstream.send(event)
+        return self.publish(event)
+
+    def publish(self, event):
+        """ Pass the event to the handlers of its level. """
+
+        # Internal events are not collected into digests
+        if self.options['digest'] and event.ntype != 'common':
+            return self.digest.add(event)
+
+        args, kwargs = event.args
+        return self.dispatcher.fan_out(self.handlers.get(event.level, []), *args, **kwargs)
 
 _LOG_LEVELS = {
     'DEBUG': logging.DEBUG,
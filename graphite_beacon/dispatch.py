@@ -0,0 +1,175 @@
+"""Deliver notifications to the handlers apart from alerts' checks."""
+
+import logging
+from collections import defaultdict, deque
+
+from tornado import gen, ioloop
+
+from .utils import parse_interval
+
+LOGGER = logging.getLogger('graphite-beacon')
+OVERFLOW = 'drop_oldest', 'drop_newest'
+
+
+class HandlerQueue(object):
+
+    """Bounded queue of notifications for one handler."""
+
+    def __init__(self, name, deliver, drop):
+        self.name = name
+        self.deliver = deliver
+        self.drop = drop
+        self.items = deque()
+        self.workers = 0
+        self.dropped = 0
+
+    def put(self, handler, method, args, kwargs, ids, size, concurrency, overflow):
+        """Queue a notification and start a worker if there is a free one."""
+        if len(self.items) >= size:
+            self.dropped += 1
+            if overflow == 'drop_newest':
+                LOGGER.warn('Handler "%s": queue is full (%d), drop a notification',
+                            self.name, size)
+                self.drop(ids)
+                return False
+            self.drop(self.items.popleft()[-1])
+            LOGGER.warn('Handler "%s": queue is full (%d), drop the oldest notification',
+                        self.name, size)
+
+        self.items.append((handler, method, args, kwargs, ids))
+        while self.workers < concurrency and self.workers < len(self.items):
+            self.workers += 1
+            ioloop.IOLoop.current().add_callback(self.work)
+        return True
+
+    @gen.coroutine
+    def work(self):
+        try:
+            while self.items:
+                yield self.deliver(*self.items.popleft())
+        finally:
+            self.workers -= 1
+
+
+class Dispatcher(object):
+
+    """Queue notifications per handler.
+
+    Handlers are called from the queues' workers, so a slow handler doesn't hold alerts'
+    checks. With `notify_queue_size` = 0 the handlers of a level are called at once. Either way
+    every delivery is bounded by `notify_timeout`, and its time and outcome are kept in `stats`.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.queues = {}
+        self.stats = defaultdict(
+            lambda: {'sent': 0, 'failed': 0, 'timeouts': 0, 'time': 0.0, 'max_time': 0.0})
+
+    def fan_out(self, handlers, *args, **kwargs):
+        """Deliver a notification to all the handlers concurrently.
+
+        Returns a future which resolves when the handlers called inline are done.
+        """
+        results = [self.dispatch(handler, *args, **kwargs) for handler in handlers]
+        return gen.multi_future([result for result in results if gen.is_future(result)])
+
+    def dispatch(self, handler, *args, **kwargs):
+        """Deliver a notification to the handler."""
+        event = kwargs.get('event')
+        ids = self.reactor.spool.track(handler, [event]) if event else ()
+        return self.submit(handler, handler.notify, args, kwargs, ids)
+
+    def dispatch_many(self, handler, events):
+        """Deliver a digest of events to the handler."""
+        ids = self.reactor.spool.track(handler, events)
+        return self.submit(handler, handler.notify_many, (events,), {}, ids)
+
+    def submit(self, handler, method, args, kwargs, ids=()):
+        options = self.reactor.options
+        size = options['notify_queue_size']
+        if not size:
+            return self.deliver(handler, method, args, kwargs, ids)
+
+        overflow = options['notify_overflow']
+        assert overflow in OVERFLOW, 'Invalid notify_overflow: %s' % overflow
+        queue = self.queues.get(handler.name)
+        if queue is None:
+            queue = self.queues[handler.name] = HandlerQueue(
+                handler.name, self.deliver, self.reactor.spool.done)
+        return queue.put(
+            handler, method, args, kwargs, ids, size, options['notify_concurrency'], overflow)
+
+    @gen.coroutine
+    def deliver(self, handler, method, args, kwargs, ids=()):
+        """Call the handler, waiting no longer than `notify_timeout`.
+
+        Failed deliveries of spooled events (`ids`) are retried by the spool.
+        """
+        loop = ioloop.IOLoop.current()
+        stats = self.stats[handler.name]
+        timeout = parse_interval(self.reactor.options['notify_timeout']) / 1000.0
+        start = loop.time()
+        try:
+            future = gen.maybe_future(method(*args, **kwargs))
+            if timeout:
+                future = gen.with_timeout(start + timeout, future)
+            yield future
+            stats['sent'] += 1
+            self.reactor.spool.done(ids)
+        except gen.TimeoutError:
+            stats['timeouts'] += 1
+            LOGGER.error('Handler "%s" timed out after %.1fs', handler.name, timeout)
+            self.reactor.spool.failed(ids)
+        except Exception as e:
+            stats['failed'] += 1
+            LOGGER.exception('Handler "%s" failed: %s', handler.name, e)
+            self.reactor.spool.failed(ids)
+        finally:
+            spent = loop.time() - start
+            stats['time'] += spent
+            stats['max_time'] = max(stats['max_time'], spent)
+
+    def depth(self):
+        """Get the number of queued notifications per handler."""
+        return dict((name, len(queue.items)) for name, queue in self.queues.items())
+
+
+class Digest(object):
+
+    """Collect an alert's events and deliver them to each handler at once.
+
+    Events are collected until the end of the current IOLoop iteration (i.e. one check of the
+    alert) or for `digest_window`.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.pending = {}
+
+    def add(self, event):
+        events = self.pending.get(event.alert)
+        if events is None:
+            events = self.pending[event.alert] = []
+            window = parse_interval(self.reactor.options['digest_window']) / 1000.0
+            loop = ioloop.IOLoop.current()
+            if window:
+                loop.add_timeout(loop.time() + window, self.flush, event.alert)
+            else:
+                loop.add_callback(self.flush, event.alert)
+        events.append(event)
+
+    def flush(self, alert):
+        events = self.pending.pop(alert, [])
+        handlers = {}
+        for event in events:
+            for handler in self.reactor.handlers.get(event.level, []):
+                handlers.setdefault(handler, []).append(event)
+
+        dispatcher = self.reactor.dispatcher
+        for handler, events in handlers.items():
+            if len(events) == 1:
+                args, kwargs = events[0].args
+                dispatcher.dispatch(handler, *args, **kwargs)
+            else:
+                dispatcher.dispatch_many(handler, events)
@@ -0,0 +1,88 @@
+"""Events passed from alerts to the handlers."""
+
+import datetime as dt
+from itertools import islice
+
+from .template import TEMPLATES
+
+# Values of the target's history kept with an event (the templates show the first 100)
+HISTORY_LIMIT = 100
+
+
+class Event(object):
+
+    """A change of an alert's target level.
+
+    Events are shared by all the handlers of the level and must not be changed. Notification
+    bodies are rendered on first use and kept, so a template is rendered once per event and
+    not once per handler.
+
+    The target's history and the values tested by the rule are captured when the event is
+    created: the alert goes on checking while the event waits in the queues (or in the spool).
+    """
+
+    __slots__ = (
+        'level', 'alert', 'value', 'target', 'ntype', 'rule', 'history', 'tested', 'rendered')
+
+    def __init__(self, level, alert, value, target=None, ntype=None, rule=None, history=None,
+                 tested=None):
+        self.level = level
+        self.alert = alert
+        self.value = value
+        self.target = target
+        self.ntype = ntype
+        self.rule = rule
+        # Internal events (loading, waiting) have no history
+        own = target is not None and ntype != 'common'
+        if history is None:
+            history = alert.history.get(target, ()) if own else ()
+        self.history = list(islice(history, HISTORY_LIMIT))
+        if tested is None:
+            tested = [
+                alert.get_value_for_expr(expr, target) for expr in rule['exprs']
+                if isinstance(expr, dict)] if own and rule else []
+        self.tested = tested
+        self.rendered = {}
+
+    def __repr__(self):
+        return '<Event %s %s:%s %s>' % (self.level, self.alert, self.target or '', self.value)
+
+    def render(self, kind, reactor, **context):
+        """Render the template of the given kind (short, text, html, ...).
+
+        `context` (e.g. a handler's `graphite_url`) is a part of the cache key, so handlers with
+        different settings get their own bodies.
+        """
+        key = (kind,) + tuple(sorted(context.items()))
+        body = self.rendered.get(key)
+        if body is None:
+            tmpl = TEMPLATES[self.ntype][kind]
+            body = self.rendered[key] = tmpl.generate(
+                level=self.level, reactor=reactor, alert=self.alert, value=self.value,
+                target=self.target, rule=self.rule, history=self.history, tested=self.tested,
+                dt=dt, **context).strip()
+        return body
+
+    def dump(self):
+        """Get a record of the event which can be serialized to JSON."""
+        return {
+            'level': self.level, 'alert': self.alert.name, 'value': self.value,
+            'target': self.target, 'ntype': self.ntype,
+            'rule': self.rule and self.rule['raw'], 'history': self.history,
+            'tested': self.tested}
+
+    @classmethod
+    def load(cls, record, alert):
+        """Make the alert's event from a record made by `dump`."""
+        rule = None
+        for rule_ in alert.rules:
+            if rule_['raw'] == record['rule']:
+                rule = rule_
+        return cls(record['level'], alert, record['value'], record['target'], record['ntype'],
+                   rule, history=record.get('history'), tested=record.get('tested'))
+
+    @property
+    def args(self):
+        """Get the arguments of `AbstractHandler.notify` for the event."""
+        return (self.level, self.alert, self.value), dict(
+            target=self.target, ntype=self.ntype, rule=self.rule, event=self)
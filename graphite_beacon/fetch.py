@@ -0,0 +1,241 @@
+"""Fetch data for alerts: the shared HTTP pool and Graphite request batching."""
+
+import logging
+from collections import deque, defaultdict
+from re import compile as re
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from tornado import ioloop, gen, escape, concurrent
+
+from .graphite import GraphiteStream
+from .utils import parse_interval
+
+LOGGER = logging.getLogger('graphite-beacon')
+
+# Every query in a batch is wrapped with `aliasSub` so the series it returns carry
+# the index of their query and can be routed back to the alert which asked for them.
+BATCH_TAG = 'beacon-{0}~'
+BATCH_TAG_RE = re(br'^beacon-(\d+)~')
+
+# A fetch which waited longer than this (seconds) for a free slot is reported
+SLOW_QUEUE_WAIT = 1.0
+
+
+class HTTPPool(object):
+
+    """HTTP client shared by the alerts.
+
+    The engine (`simple` or `curl`) and its `max_clients` are taken from the reactor's options.
+    `backend_concurrency` limits simultaneous requests to one host; the time a request spends
+    waiting for a slot is kept in `stats` to help sizing the pool.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.settings = None
+        self.client = None
+        self.active = defaultdict(int)
+        self.waiters = defaultdict(deque)
+        self.stats = defaultdict(lambda: {'requests': 0, 'wait': 0.0, 'max_wait': 0.0})
+
+    def configure(self):
+        """Recreate the HTTP client when the engine options have changed."""
+        settings = (self.reactor.options['http_client'], self.reactor.options['max_clients'])
+        if settings == self.settings:
+            return
+        engine, max_clients = self.settings = settings
+
+        if engine == 'curl':
+            from tornado.curl_httpclient import CurlAsyncHTTPClient as client_class
+        elif engine == 'simple':
+            from tornado.simple_httpclient import SimpleAsyncHTTPClient as client_class
+        else:
+            raise ValueError('Unknown HTTP client: %s' % engine)
+
+        if self.client is not None:
+            self.client.close()
+        self.client = client_class(force_instance=True, max_clients=max_clients)
+        LOGGER.info('HTTP client: %s (max_clients=%s)', engine, max_clients)
+
+    @gen.coroutine
+    def fetch(self, url, **kwargs):
+        """Fetch the URL when the backend has a free slot."""
+        backend = urlparse(url).netloc
+        limit = self.reactor.options['backend_concurrency']
+        loop = ioloop.IOLoop.current()
+
+        start = loop.time()
+        if limit and self.active[backend] >= limit:
+            # The slot is handed over by `release`
+            waiter = concurrent.Future()
+            self.waiters[backend].append(waiter)
+            yield waiter
+        else:
+            self.active[backend] += 1
+        self.account(backend, loop.time() - start)
+
+        try:
+            response = yield self.client.fetch(url, **kwargs)
+        finally:
+            self.release(backend)
+
+        # Time spent in the engine's own queue (curl only)
+        queue = response.time_info.get('queue')
+        if queue:
+            self.account(backend, queue, count=False)
+
+        raise gen.Return(response)
+
+    def release(self, backend):
+        waiters = self.waiters[backend]
+        if waiters:
+            waiters.popleft().set_result(None)
+        else:
+            self.active[backend] -= 1
+
+    def account(self, backend, wait, count=True):
+        stats = self.stats[backend]
+        if count:
+            stats['requests'] += 1
+        stats['wait'] += wait
+        stats['max_wait'] = max(stats['max_wait'], wait)
+        if wait > SLOW_QUEUE_WAIT:
+            LOGGER.warn('Request to %s waited %.2fs for a connection. Active: %d, queued: %d',
+                        backend, wait, self.active[backend], len(self.waiters[backend]))
+
+
+class FetchCache(object):
+
+    """Share fetched records between alerts with identical queries.
+
+    A request already in flight is reused, and its result is reused for `cache_ttl` after it
+    has completed. Failed requests are not cached.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.entries = {}
+
+    def fetch(self, key, loader):
+        """Get a future for the key, calling the loader when there is no usable entry."""
+        future = self.entries.get(key)
+        if future is not None:
+            return future
+
+        future = self.entries[key] = loader()
+        future.add_done_callback(lambda f: self.expire(key, f))
+        return future
+
+    def expire(self, key, future):
+        ttl = parse_interval(self.reactor.options['cache_ttl']) / 1000.0
+        if future.exception() is None and ttl:
+            loop = ioloop.IOLoop.current()
+            loop.add_timeout(loop.time() + ttl, self.remove, key, future)
+        else:
+            self.remove(key, future)
+
+    def remove(self, key, future):
+        if self.entries.get(key) is future:
+            del self.entries[key]
+
+
+class GraphiteBatcher(object):
+
+    """Merge render requests of alerts which share a Graphite window.
+
+    Alerts with the same `graphite_url`, `time_window` and `until` are loaded with a single
+    `/render?target=...&target=...&rawData=true` request. When the request fails the queries
+    are retried one by one.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.pending = {}
+        self.timeouts = {}
+
+    @property
+    def enabled(self):
+        return self.reactor.options.get('batch_size', 0) > 1
+
+    def fetch(self, alert, time_window=None):
+        """Queue the alert's query and return a future with its Graphite records."""
+        key = (alert.graphite_url, time_window or alert.time_window, alert.until,
+               alert.auth_username, alert.auth_password)
+        future = concurrent.Future()
+
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = []
+            window = parse_interval(self.reactor.options.get('batch_window', 0)) / 1000.0
+            loop = ioloop.IOLoop.current()
+            if window:
+                self.timeouts[key] = loop.add_timeout(loop.time() + window, self.flush, key)
+            else:
+                loop.add_callback(self.flush, key)
+
+        batch.append((alert, future))
+        if len(batch) >= self.reactor.options['batch_size']:
+            self.flush(key)
+
+        return future
+
+    def flush(self, key):
+        """Send the queued queries for the key."""
+        # A batch filled up before its window has ended must not cut the next one short
+        timeout = self.timeouts.pop(key, None)
+        if timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(timeout)
+        batch = self.pending.pop(key, None)
+        if batch:
+            self.load(key[1], batch)
+
+    @gen.coroutine
+    def load(self, time_window, batch):
+        """Load records for a batch and route them to the alerts' futures."""
+        targets = "&".join(
+            "target=%s" % escape.url_escape('aliasSub(%s, "^", "%s")' % (
+                a.query, BATCH_TAG.format(num))) for num, (a, _) in enumerate(batch))
+        alert = batch[0][0]
+        body = "{targets}&from=-{time_window}&until=-{until}&rawData=true".format(
+            targets=targets, time_window=time_window, until=alert.until)
+        LOGGER.debug('Load a batch of %d queries from %s', len(batch), alert.graphite_url)
+
+        records = [[] for _ in batch]
+
+        def route(line):
+            match = BATCH_TAG_RE.match(line)
+            if not match:
+                LOGGER.warn('Skip an untagged series in a batch response: %r', line[:100])
+                return
+            num = int(match.group(1))
+            records[num].append(batch[num][0].parse(line[match.end():]))
+
+        stream = GraphiteStream(route)
+        try:
+            yield alert.client.fetch(
+                "%s/render/" % alert.graphite_url, method='POST', body=body,
+                auth_username=alert.auth_username,
+                auth_password=alert.auth_password,
+                request_timeout=max(a.request_timeout for a, _ in batch),
+                connect_timeout=max(a.connect_timeout for a, _ in batch),
+                streaming_callback=stream.feed,
+                header_callback=stream.header,
+            )
+            stream.close()
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Graphite rejects the whole request for one bad query, so a failed batch is
+            # loaded again query by query and only the broken alerts fail
+            LOGGER.warn('A batch of %d queries to %s has failed (%s), load them one by one',
+                        len(batch), alert.graphite_url, e)
+            for alert, future in batch:
+                concurrent.chain_future(alert._fetch(time_window), future)
+            return
+
+        for (_, future), result in zip(batch, records):
+            future.set_result(result)
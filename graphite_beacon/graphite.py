@@ -1,44 +1,146 @@
+from array import array
+
+NAN = float('nan')
+
+
 class GraphiteRecord(object):
 
+    """A Graphite series with all aggregates computed in one pass while parsing."""
+
+    __slots__ = (
+        'target', 'start_time', 'end_time', 'step', 'values', 'empty',
+        'average', 'last_value', 'sum', 'min', 'max')
+
     def __init__(self, metric_string, default_nan_value=None, ignore_nan=False):
+        self.target, self.start_time, self.end_time, self.step, data = self.split(metric_string)
+        self.aggregate(data, default_nan_value, ignore_nan)
+
+    @staticmethod
+    def split(metric_string):
+        """Split a rawData line to target, start_time, end_time, step and raw values."""
         meta, data = metric_string.split('|')
-        self.target, start_time, end_time, step = meta.rsplit(',', 3)
-        self.start_time = int(start_time)
-        self.end_time = int(end_time)
-        self.step = int(step)
-        self.default_nan_value = default_nan_value
-        self.ignore_nan = ignore_nan
-        self.values = list(self._values(data.rsplit(',')))
-        if len(self.values) == 0:
-            self.empty = True
-        else:
-            self.empty = False
-
-    def _values(self, values):
-        for value in values:
+        target, start_time, end_time, step = meta.rsplit(',', 3)
+        return target, int(start_time), int(end_time), int(step), data.split(',')
+
+    @classmethod
+    def from_window(cls, target, window, default_nan_value=None, ignore_nan=False):
+        """Make a record from the points of a window."""
+        record = cls.__new__(cls)
+        record.target = target
+        record.step = window.step
+        record.end_time = window.end_time
+        record.start_time = window.end_time - window.step * len(window.values)
+        record.aggregate(window.points(), default_nan_value, ignore_nan)
+        return record
+
+    def aggregate(self, data, default_nan_value, ignore_nan):
+        values = self.values = array('d')
+        total, low, high = 0.0, None, None
+        for value in data:
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            if value != value:
+                continue
+            if ignore_nan and value == default_nan_value:
+                continue
+            values.append(value)
+            total += value
+            if low is None or value < low:
+                low = value
+            if high is None or value > high:
+                high = value
+
+        self.empty = not values
+        self.sum = total
+        self.min = low
+        self.max = high
+        self.last_value = values[-1] if values else None
+        self.average = total / len(values) if values else None
+
+
+class GraphiteWindow(object):
+
+    """The latest points of a series kept in a ring buffer.
+
+    Points fetched incrementally are merged in by timestamp; `end_time` is the timestamp of the
+    next point to come. Missing points are NaN.
+    """
+
+    __slots__ = ('step', 'end_time', 'values', 'pos', 'generation')
+
+    def __init__(self, step, size):
+        self.step = step
+        self.end_time = None
+        self.values = array('d', [NAN]) * size
+        self.pos = 0
+        self.generation = None
+
+    def update(self, start_time, data):
+        """Merge raw values starting at start_time."""
+        size = len(self.values)
+        for num, value in enumerate(data):
             try:
-                if self.ignore_nan and float(value) == self.default_nan_value:
-                    continue
-                yield float(value)
+                value = float(value)
             except ValueError:
+                value = NAN
+            timestamp = start_time + num * self.step
+            if self.end_time is None:
+                self.end_time = timestamp
+
+            if timestamp < self.end_time:
+                back = (self.end_time - timestamp) // self.step
+                if back <= size:
+                    self.values[(self.pos - back) % size] = value
                 continue
 
-    @property
-    def average(self):
-        return self.sum / len(self.values)
+            if timestamp - self.end_time >= size * self.step:
+                for pos in range(size):
+                    self.values[pos] = NAN
+                self.end_time = timestamp
+
+            while self.end_time <= timestamp:
+                self.values[self.pos] = value if self.end_time == timestamp else NAN
+                self.pos = (self.pos + 1) % size
+                self.end_time += self.step
+
+    def points(self):
+        """Iterate over the points from the oldest one."""
+        for pos in range(len(self.values)):
+            yield self.values[(self.pos + pos) % len(self.values)]
+
+
+class GraphiteStream(object):
+
+    """Split a rawData response into lines as its chunks arrive.
+
+    Use `feed` as the HTTP client's `streaming_callback` so every series is handled as soon as
+    its line is complete and the raw body is never buffered as a whole. Use `header` as the
+    `header_callback` to skip the bodies of error responses (e.g. Graphite's error pages).
+    """
 
-    @property
-    def last_value(self):
-        return self.values[-1]
+    def __init__(self, callback):
+        self.callback = callback
+        self.tail = b''
+        self.ok = True
 
-    @property
-    def sum(self):
-        return sum(self.values)
+    def header(self, line):
+        if line.startswith('HTTP/'):
+            # The status line of every response, redirects included
+            self.ok = line.split(' ', 2)[1] == '200'
+            self.tail = b''
 
-    @property
-    def min(self):
-        return min(self.values)
+    def feed(self, chunk):
+        if not self.ok:
+            return
+        lines = (self.tail + chunk).split(b'\n')
+        self.tail = lines.pop()
+        for line in lines:
+            if line:
+                self.callback(line)
 
-    @property
-    def max(self):
-        return max(self.values)
+    def close(self):
+        if self.tail and self.ok:
+            self.callback(self.tail)
+        self.tail = b''
@@ -1,6 +1,11 @@
+import datetime as dt
 import logging
 
+from tornado import gen
+
 from graphite_beacon import _compat as _
+from graphite_beacon.alerts import LEVELS
+from graphite_beacon.events import Event
 from graphite_beacon.template import TEMPLATES
 
 LOGGER = logging.getLogger('graphite-beacon')
@@ -21,6 +26,8 @@ class HandlerMeta(type):
 
     @classmethod
     def clean(mcs):
+        for handler in mcs.loaded.values():
+            handler.stop()
         mcs.loaded = {}
 
     @classmethod
@@ -42,18 +49,41 @@ class AbstractHandler(_.with_metaclass(HandlerMeta)):
         self.init_handler()
         LOGGER.debug('Handler "%s" has inited: %s', self.name, self.options)
 
-    def get_short(self, level, alert, value, target=None, ntype=None, rule=None):
-        tmpl = TEMPLATES[ntype]['short']
+    def get_short(self, level, alert, value, target=None, ntype=None, rule=None, event=None):
+        if event is None:
+            event = Event(level, alert, value, target, ntype, rule)
+        return event.render('short', self.reactor)
+
+    @staticmethod
+    def get_level(events):
+        """ Get the most severe level of the events. """
+        return min((event.level for event in events), key=lambda level: LEVELS.get(level, 99))
+
+    def get_digest(self, events, kind='short'):
+        """ Render a digest of an alert's events. """
+        tmpl = TEMPLATES['digest'][kind]
         return tmpl.generate(
-            level=level, reactor=self.reactor, alert=alert, value=value, target=target).strip()
+            level=self.get_level(events), reactor=self.reactor, alert=events[0].alert,
+            events=events, dt=dt).strip()
 
     def init_handler(self):
         """ Init configuration here."""
         raise NotImplementedError()
 
-    def notify(self, level, alert, value, target=None, ntype=None, rule=None):
+    def stop(self):
+        """ Stop background tasks, the handler is going to be replaced."""
+        pass
+
+    def notify(self, level, alert, value, target=None, ntype=None, rule=None, event=None):
         raise NotImplementedError()
 
+    @gen.coroutine
+    def notify_many(self, events):
+        """ Handle a digest of an alert's events. By default events are sent one by one. """
+        for event in events:
+            args, kwargs = event.args
+            yield gen.maybe_future(self.notify(*args, **kwargs))
+
 registry = HandlerMeta
 
 from .hipchat import HipChatHandler      # noqa
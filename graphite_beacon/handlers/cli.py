@@ -1,6 +1,14 @@
-import subprocess
+import json
+import os
+import signal
+from collections import deque
+from functools import partial
+
+from tornado import ioloop, iostream
+from tornado.process import Subprocess
 
 from graphite_beacon.handlers import AbstractHandler, LOGGER
+from graphite_beacon.utils import parse_interval
 
 
 class CliHandler(AbstractHandler):
@@ -10,13 +18,27 @@ class CliHandler(AbstractHandler):
     # Default options
     defaults = {
         'command': None,
+        'batch_command': None,
+        'batch_size': 100,
         'alerts_whitelist': [],
+        'pool_size': 4,
+        'queue_size': 1000,
+        'timeout': '1minute',
     }
 
     def init_handler(self):
         self.commandTemplate = self.options.get('command')
+        self.batchCommand = self.options.get('batch_command')
         self.whitelist = self.options.get('alerts_whitelist')
-        assert self.commandTemplate, 'Command line command is not defined.'
+        assert self.commandTemplate or self.batchCommand, 'Command line command is not defined.'
+        self.timeout = parse_interval(self.options['timeout']) / 1000.0
+        self.queue = deque()
+        self.batch = []
+        self.running = {}
+
+    def stop(self):
+        del self.batch[:]
+        self.queue.clear()
 
     def notify(self, level, *args, **kwargs):
         LOGGER.debug("Handler (%s) %s", self.name, level)
@@ -28,14 +50,76 @@ class CliHandler(AbstractHandler):
 
         # Run only for whitelisted names if specified
         if not self.whitelist or getAlertName(*args) in self.whitelist:
-            command = substituteVariables(self.commandTemplate, level, *args, **kwargs)
-            subprocess.Popen(
-                command,
-                shell=True,
-                stdin=None,
-                stdout=None,
-                stderr=None,
-                close_fds=True)
+            if self.batchCommand:
+                self.add_line(level, *args, **kwargs)
+            else:
+                self.run(substituteVariables(self.commandTemplate, level, *args, **kwargs))
+
+    def add_line(self, level, name, value, target=None, **kwargs):
+        """Pass the event to the batch command. Events are sent to its stdin as JSON lines."""
+        rule = kwargs.get('rule')
+        self.batch.append(json.dumps({
+            'level': level, 'name': str(name), 'value': value, 'target': target,
+            'limit_value': rule.get('value') if rule else None,
+        }, default=str))
+        if len(self.batch) >= self.options['batch_size']:
+            self.flush()
+        elif len(self.batch) == 1:
+            ioloop.IOLoop.current().add_callback(self.flush)
+
+    def flush(self):
+        lines, self.batch[:] = list(self.batch), []
+        if lines:
+            self.run(self.batchCommand, "\n".join(lines) + "\n")
+
+    def run(self, command, stdin=None):
+        """Queue the command and start it when there is a free slot in the pool."""
+        if len(self.queue) >= self.options['queue_size']:
+            LOGGER.warn('Handler (%s): queue is full, drop the oldest command', self.name)
+            self.queue.popleft()
+        self.queue.append((command, stdin))
+        self.spawn()
+
+    def spawn(self):
+        loop = ioloop.IOLoop.current()
+        while self.queue and len(self.running) < self.options['pool_size']:
+            command, stdin = self.queue.popleft()
+            try:
+                proc = Subprocess(
+                    command, shell=True, close_fds=True, preexec_fn=os.setsid,
+                    stdin=Subprocess.STREAM if stdin else None)
+            except OSError as e:
+                LOGGER.error('Handler (%s): command "%s" failed: %s', self.name, command, e)
+                continue
+
+            timeout = None
+            if self.timeout:
+                timeout = loop.add_timeout(loop.time() + self.timeout, partial(self.kill, proc))
+            self.running[proc.pid] = timeout
+            proc.set_exit_callback(partial(self.reap, proc, command))
+
+            if stdin:
+                try:
+                    proc.stdin.write(stdin.encode('utf-8'), callback=proc.stdin.close)
+                except iostream.StreamClosedError:
+                    pass
+
+    def kill(self, proc):
+        """Kill the command with the processes it has started."""
+        LOGGER.error('Handler (%s): command timed out, kill it (pid %s)', self.name, proc.pid)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def reap(self, proc, command, returncode):
+        timeout = self.running.pop(proc.pid, None)
+        if timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(timeout)
+        if returncode:
+            LOGGER.warn('Handler (%s): command "%s" exited with %s', self.name, command,
+                        returncode)
+        self.spawn()
 
 
 def substituteVariables(command, level, name, value, target=None, **kwargs):
@@ -29,12 +29,18 @@ class HipChatHandler(AbstractHandler):
         assert self.key, 'Hipchat key is not defined.'
         self.client = hc.AsyncHTTPClient()
 
-    @gen.coroutine
     def notify(self, level, *args, **kwargs):
         LOGGER.debug("Handler (%s) %s", self.name, level)
+        return self.send(level, self.get_short(level, *args, **kwargs))
+
+    def notify_many(self, events):
+        LOGGER.debug("Handler (%s) digest of %d events", self.name, len(events))
+        return self.send(self.get_level(events), self.get_digest(events))
 
+    @gen.coroutine
+    def send(self, level, message):
         data = {
-            'message': self.get_short(level, *args, **kwargs).decode('UTF-8'),
+            'message': message.decode('UTF-8'),
             'notify': True,
             'color': self.colors.get(level, 'gray'),
             'message_format': 'text',
@@ -23,10 +23,11 @@ class HttpHandler(AbstractHandler):
         self.client = hc.AsyncHTTPClient()
 
     @gen.coroutine
-    def notify(self, level, alert, value, target=None, ntype=None, rule=None):
+    def notify(self, level, alert, value, target=None, ntype=None, rule=None, event=None):
         LOGGER.debug("Handler (%s) %s", self.name, level)
 
-        message = self.get_short(level, alert, value, target=target, ntype=ntype, rule=rule)
+        message = self.get_short(
+            level, alert, value, target=target, ntype=ntype, rule=rule, event=event)
         data = {'alert': alert.name, 'desc': message, 'level': level}
         if target:
             data['target'] = target
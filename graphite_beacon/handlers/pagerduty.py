@@ -26,15 +26,37 @@ class PagerdutyHandler(AbstractHandler):
         self.client = hc.AsyncHTTPClient()
 
     @gen.coroutine
-    def notify(self, level, alert, value, target=None, ntype=None, rule=None):
+    def notify(self, level, alert, value, target=None, ntype=None, rule=None, event=None):
         LOGGER.debug("Handler (%s) %s", self.name, level)
-        message = self.get_short(level, alert, value, target=target, ntype=ntype, rule=rule)
+        message = self.get_short(
+            level, alert, value, target=target, ntype=ntype, rule=rule, event=event)
         LOGGER.debug('message1:%s', message)
-        if level == 'normal':
-            event_type = 'resolve'
-        else:
-            event_type = 'trigger'
+        yield self.send(self.get_event_type(level), self.get_incident_key(rule), message)
 
+    @gen.coroutine
+    def notify_many(self, events):
+        """ Send a digest per incident, the targets of a rule share its incident key. """
+        LOGGER.debug("Handler (%s) digest of %d events", self.name, len(events))
+        incidents = {}
+        for event in events:
+            key = self.get_event_type(event.level), self.get_incident_key(event.rule)
+            incidents.setdefault(key, []).append(event)
+
+        yield [
+            self.send(event_type, incident_key, self.get_digest(events) if len(events) > 1
+                      else events[0].render('short', self.reactor))
+            for (event_type, incident_key), events in incidents.items()]
+
+    @staticmethod
+    def get_event_type(level):
+        return 'resolve' if level == 'normal' else 'trigger'
+
+    @staticmethod
+    def get_incident_key(rule):
+        return rule['raw'] if rule is not None else 'graphite connect error'
+
+    @gen.coroutine
+    def send(self, event_type, incident_key, message):
         headers = {
             "Content-type": "application/json",
         }
@@ -44,7 +66,7 @@ class PagerdutyHandler(AbstractHandler):
             "event_type": event_type,
             "description": message,
             "details": message,
-            "incident_key":  rule['raw'] if rule is not None else 'graphite connect error',
+            "incident_key": incident_key,
             "client": 'graphite-beacon',
             "client_url": None
         }
@@ -1,8 +1,13 @@
 """Dispatch alerts via Slack."""
-from slacker import Slacker
-import requests
-from tornado import httpclient as hc
+import json
+import time
+import urllib
+from collections import defaultdict
+from uuid import uuid4
 
+from tornado import gen, ioloop, httpclient as hc
+
+from graphite_beacon.utils import parse_interval
 from . import AbstractHandler, LOGGER
 
 INTERNAL_ERRORS = (
@@ -13,6 +18,8 @@ INTERNAL_RECOVERY = (
     'Metrics are loaded',
 )
 BOT_CHANNEL = '#bot_files'
+SLACK_API = 'https://slack.com/api/'
+
 
 class SlackHandler(AbstractHandler):
 
@@ -25,6 +32,9 @@ class SlackHandler(AbstractHandler):
         'webhook': None,
         'channel': None,
         'username': 'graphite-beacon',
+        'channels_ttl': '10minute',
+        'image_ttl': '1minute',
+        'image_burst': 3,
     }
 
     colors = {
@@ -47,51 +57,145 @@ class SlackHandler(AbstractHandler):
         """Startup initialization for Slack."""
         self.token = self.options.get('token')
         assert self.token, 'Slack api token is not defined.'
-        self.slack = Slacker(self.token)
         self.username = self.options.get('username')
         self.client = hc.AsyncHTTPClient()
 
+        # Channel name -> ID, refreshed in background. Names which are not listed (private
+        # channels, users, IDs) are not looked up again until the next refresh
+        self.channels = {}
+        self.channels_missing = set()
+        self.channels_loading = None
+        self.channels_callback = ioloop.PeriodicCallback(
+            self.load_channels, parse_interval(self.options['channels_ttl']))
+        self.channels_callback.start()
+        self.load_channels()
+
+        # Uploaded graphs (render URL -> future with url_private) of the current time bucket
+        self.images = {}
+        self.images_bucket = None
+        self.bursts = defaultdict(int)
+
+    def stop(self):
+        self.channels_callback.stop()
+
+    @gen.coroutine
+    def api(self, method, body=None, headers=None, **params):
+        """Call a method of Slack Web API."""
+        params['token'] = self.token
+        if body is None:
+            body = urllib.urlencode(params)
+            url = SLACK_API + method
+        else:
+            url = '%s%s?%s' % (SLACK_API, method, urllib.urlencode(params))
+        response = yield self.client.fetch(url, method='POST', body=body, headers=headers)
+        result = json.loads(response.body.decode('utf-8'))
+        if not result.get('ok'):
+            raise ValueError('Slack %s failed: %s' % (method, result.get('error')))
+        raise gen.Return(result)
+
+    def load_channels(self):
+        """Reload the channels' IDs unless a reload is in progress."""
+        if self.channels_loading is None or self.channels_loading.done():
+            self.channels_loading = self._load_channels()
+        return self.channels_loading
+
+    @gen.coroutine
+    def _load_channels(self):
+        try:
+            result = yield self.api('channels.list', exclude_archived=1)
+        except Exception as e:
+            LOGGER.error('Slack: unable to load channels: %s', e)
+            return
+        self.channels = dict(
+            (channel['name'], channel['id']) for channel in result.get('channels', []))
+        self.channels_missing = set()
+
+    @gen.coroutine
+    def get_channel_id(self, channel):
+        """Get the channel's ID from the cache. Unknown channels are used by name."""
+        name = channel.lstrip('#')
+        if name not in self.channels and name not in self.channels_missing:
+            yield self.load_channels()
+            if name not in self.channels:
+                self.channels_missing.add(name)
+        raise gen.Return(self.channels.get(name, channel))
+
+    def get_image(self, alert, target):
+        """Get a graph for the target, uploaded once per render URL and time bucket.
+
+        When `image_burst` targets of an alert are notified in the same bucket, the rest of
+        them share one graph of the whole alert's query. With `image_ttl` = 0 every
+        notification uploads its own graph.
+        """
+        ttl = parse_interval(self.options['image_ttl'])
+        if not ttl:
+            return self.post_image(alert.get_attachment_url(target))
+
+        bucket = int(time.time() * 1000 // ttl)
+        if bucket != self.images_bucket:
+            self.images_bucket = bucket
+            self.images = {}
+            self.bursts = defaultdict(int)
+
+        self.bursts[alert.name] += 1
+        burst = self.options['image_burst']
+        if burst and self.bursts[alert.name] >= burst:
+            url = alert.get_attachment_url(alert.query)
+        else:
+            url = alert.get_attachment_url(target)
+
+        future = self.images.get(url)
+        if future is None:
+            future = self.images[url] = self.post_image(url)
+            future.add_done_callback(lambda f: self.forget_image(url, f))
+        return future
+
+    def forget_image(self, url, future):
+        """Don't keep failed uploads."""
+        if (future.exception() or not future.result()) and self.images.get(url) is future:
+            del self.images[url]
+
+    @gen.coroutine
     def post_image(self, url):
         """Post an image to Slack so it can be attached to a message."""
-        d = requests.get(url)
-        if d.status_code != 200:
-            return None
-        r = self.slack.files.post(
-            'files.upload',
-            files={'file': d.content},
-            params={
-                'filename': 'graphite-beacon.png',
-                'filetype': 'png',
-                'channels': BOT_CHANNEL,
-            },
-        )
         try:
-            url = r.body['file']['url_private']
-            LOGGER.info("Posted URL: %s", url)
-            return url
-        except KeyError:
-            LOGGER.error("Unable to get URL for image: %r", r)
-            return None
-
-    # @gen.coroutine
+            image = yield self.client.fetch(url)
+        except hc.HTTPError as e:
+            LOGGER.error("Unable to load image %s: %s", url, e)
+            raise gen.Return(None)
+
+        boundary = uuid4().hex
+        body = b''.join((
+            ('--%s\r\n' % boundary).encode('utf-8'),
+            b'Content-Disposition: form-data; name="file"; filename="graphite-beacon.png"\r\n',
+            b'Content-Type: image/png\r\n\r\n',
+            image.body,
+            ('\r\n--%s--\r\n' % boundary).encode('utf-8'),
+        ))
+        try:
+            result = yield self.api(
+                'files.upload', body=body,
+                headers={'Content-Type': 'multipart/form-data; boundary=%s' % boundary},
+                filename='graphite-beacon.png', filetype='png', channels=BOT_CHANNEL)
+            url = result['file']['url_private']
+        except (ValueError, KeyError) as e:
+            LOGGER.error("Unable to get URL for image: %s", e)
+            raise gen.Return(None)
+
+        LOGGER.info("Posted URL: %s", url)
+        raise gen.Return(url)
+
+    @gen.coroutine
     def notify(self, level, alert, value, **kwargs):
         LOGGER.debug("Handler (%s) %s", self.name, level)
 
         target = kwargs['target']
 
-        image_url = alert.get_attachment_url(target)
         try:
             rule = kwargs['rule']['raw']
         except (KeyError, TypeError):
             rule = 'N/A'
 
-        # Allow for overridable channel per-rule.
-
-        if alert.channel:
-            channel = alert.channel
-        else:
-            channel = self.options.get('channel')
-
         # For the lazy. (i.e. Me.)
         def _short(title, value):
             return {'title': title, 'value': value, 'short': True}
@@ -115,7 +219,7 @@ class SlackHandler(AbstractHandler):
             }
         elif level == 'normal':
             attachment = {
-                'image_url': self.post_image(image_url),
+                'image_url': (yield self.get_image(alert, target)),
                 'color': self.colors[level],
                 'fields': [
                     _long('Alert Cleared', alert.name),
@@ -126,7 +230,7 @@ class SlackHandler(AbstractHandler):
             }
         else:
             attachment = {
-                'image_url': self.post_image(image_url),
+                'image_url': (yield self.get_image(alert, target)),
                 'color': self.colors[level],
                 'fields': [
                     _long('Alert Triggered', alert.name),
@@ -136,13 +240,42 @@ class SlackHandler(AbstractHandler):
                 ]
             }
 
-        channel_id = self.slack.channels.get_channel_id(channel)
+        yield self.post(alert, level, attachment)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def notify_many(self, events):
+        LOGGER.debug("Handler (%s) digest of %d events", self.name, len(events))
+
+        alert = events[0].alert
+        level = self.get_level(events)
+        fields = [{'title': 'Alert', 'value': alert.name, 'short': False}]
+        for event in events:
+            rule = event.rule['raw'] if event.rule and event.level != 'normal' else 'Cleared'
+            fields.append({
+                'title': '%s: %s' % (event.level.upper(), event.target),
+                'value': '%s (%s)' % (alert.convert(event.value), rule),
+                'short': True,
+            })
+
+        attachment = {
+            'image_url': (yield self.get_image(alert, alert.query)),
+            'color': self.colors.get(level),
+            'fields': fields,
+        }
+        yield self.post(alert, level, attachment)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def post(self, alert, level, attachment):
+        channel = alert.channel or self.options.get('channel')
+        channel_id = yield self.get_channel_id(channel)
         LOGGER.info("Posting message with attachment: %r", attachment)
-        self.slack.chat.post_message(
-            channel_id,
+        yield self.api(
+            'chat.postMessage',
+            channel=channel_id,
             text='',
             username=self.username,
             icon_emoji=self.emoji.get(level, ':warning:'),
-            attachments=[attachment]
+            attachments=json.dumps([attachment]),
         )
-        return True
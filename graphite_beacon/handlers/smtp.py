@@ -1,11 +1,17 @@
-import datetime as dt
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from smtplib import SMTP
+from smtplib import SMTP, SMTPServerDisconnected
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
-from tornado import gen, concurrent
+from tornado import gen, concurrent, ioloop
 
-from graphite_beacon.handlers import AbstractHandler, TEMPLATES, LOGGER
+from graphite_beacon.events import Event
+from graphite_beacon.handlers import AbstractHandler, LOGGER
+from graphite_beacon.utils import parse_interval
 
 
 class SMTPHandler(AbstractHandler):
@@ -23,6 +29,9 @@ class SMTPHandler(AbstractHandler):
         'use_tls': False,
         'html': True,
         'graphite_url': None,
+        'pool_size': 2,
+        'idle_timeout': '1minute',
+        'max_messages': 100,
     }
 
     def init_handler(self):
@@ -31,6 +40,10 @@ class SMTPHandler(AbstractHandler):
         assert self.options.get('to'), 'Recepients list is empty. SMTP disabled.'
         if not isinstance(self.options['to'], (list, tuple)):
             self.options['to'] = [self.options['to']]
+        self.pool = SMTPPool(self.options)
+
+    def stop(self):
+        self.pool.stop()
 
     @gen.coroutine
     def notify(self, level, *args, **kwargs):
@@ -41,48 +54,126 @@ class SMTPHandler(AbstractHandler):
         msg['From'] = self.options['from']
         msg['To'] = ", ".join(self.options['to'])
 
-        smtp = SMTP()
-        yield smtp_connect(smtp, self.options['host'], self.options['port'])
+        LOGGER.debug("Send message to: %s", ", ".join(self.options['to']))
+        yield self.pool.send(self.options['from'], self.options['to'], msg.as_string())
 
-        if self.options['use_tls']:
-            yield smtp_starttls(smtp)
+    @gen.coroutine
+    def notify_many(self, events):
+        LOGGER.debug("Handler (%s) digest of %d events", self.name, len(events))
 
-        if self.options['username'] and self.options['password']:
-            yield smtp_login(smtp, self.options['username'], self.options['password'])
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(str(self.get_digest(events, 'text')), 'plain'))
+        if self.options['html']:
+            msg.attach(MIMEText(str(self.get_digest(events, 'html')), 'html'))
+        msg['Subject'] = self.get_digest(events)
+        msg['From'] = self.options['from']
+        msg['To'] = ", ".join(self.options['to'])
 
-        try:
-            LOGGER.debug("Send message to: %s", ", ".join(self.options['to']))
-            smtp.sendmail(self.options['from'], self.options['to'], msg.as_string())
-        finally:
-            smtp.quit()
+        yield self.pool.send(self.options['from'], self.options['to'], msg.as_string())
 
-    def get_message(self, level, alert, value, target=None, ntype=None, rule=None):
-        txt_tmpl = TEMPLATES[ntype]['text']
-        ctx = dict(
-            reactor=self.reactor, alert=alert, value=value, level=level, target=target,
-            dt=dt, rule=rule, **self.options)
+    def get_message(self, level, alert, value, target=None, ntype=None, rule=None, event=None):
+        if event is None:
+            event = Event(level, alert, value, target, ntype, rule)
+        graphite_url = self.options['graphite_url']
         msg = MIMEMultipart('alternative')
-        plain = MIMEText(str(txt_tmpl.generate(**ctx)), 'plain')
+        plain = MIMEText(str(event.render('text', self.reactor, graphite_url=graphite_url)),
+                         'plain')
         msg.attach(plain)
         if self.options['html']:
-            html_tmpl = TEMPLATES[ntype]['html']
-            html = MIMEText(str(html_tmpl.generate(**ctx)), 'html')
+            html = MIMEText(str(event.render('html', self.reactor, graphite_url=graphite_url)),
+                            'html')
             msg.attach(html)
         return msg
 
 
-@concurrent.return_future
-def smtp_connect(smtp, host, port, callback):
-    callback(smtp.connect(host, port))
-
-
-@concurrent.return_future
-def smtp_starttls(smtp, callback):
-    callback(smtp.starttls())
-
-
-@concurrent.return_future
-def smtp_login(smtp, username, password, callback):
-    callback(smtp.login(username, password))
-
-#  pylama:ignore=E1120
+class SMTPPool(object):
+
+    """Send messages from worker threads which keep authenticated SMTP sessions.
+
+    Up to `pool_size` workers take messages from a shared queue and send them one after
+    another over their connection, reconnecting after `max_messages` messages or when the
+    server has closed the session. A worker quits after `idle_timeout` without messages.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.queue = Queue()
+        # Running workers, changed under the lock
+        self.workers = 0
+        self.lock = threading.Lock()
+
+    def send(self, from_addr, to_addrs, message):
+        """Queue a message and return a future for the result of the sending."""
+        future = concurrent.Future()
+        self.queue.put((from_addr, to_addrs, message, future, ioloop.IOLoop.current()))
+        with self.lock:
+            if self.workers < self.options['pool_size']:
+                self.workers += 1
+                worker = threading.Thread(target=self.work, name='beacon-smtp')
+                worker.daemon = True
+                worker.start()
+        return future
+
+    def stop(self):
+        with self.lock:
+            workers = self.workers
+        for _ in range(workers):
+            self.queue.put(None)
+
+    def connect(self):
+        smtp = SMTP()
+        smtp.connect(self.options['host'], self.options['port'])
+        if self.options['use_tls']:
+            smtp.starttls()
+        if self.options['username'] and self.options['password']:
+            smtp.login(self.options['username'], self.options['password'])
+        return smtp
+
+    def work(self):
+        smtp, sent = None, 0
+        timeout = parse_interval(self.options['idle_timeout']) / 1000.0
+        while True:
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                # A message queued before the worker has left would wait for the next `send`
+                with self.lock:
+                    if self.queue.empty():
+                        self.workers -= 1
+                        break
+                continue
+            if item is None:
+                with self.lock:
+                    self.workers -= 1
+                break
+
+            from_addr, to_addrs, message, future, loop = item
+            try:
+                if smtp is not None and sent >= self.options['max_messages']:
+                    self.quit(smtp)
+                    smtp = None
+                if smtp is None:
+                    smtp, sent = self.connect(), 0
+                try:
+                    result = smtp.sendmail(from_addr, to_addrs, message)
+                except SMTPServerDisconnected:
+                    smtp, sent = self.connect(), 0
+                    result = smtp.sendmail(from_addr, to_addrs, message)
+                sent += 1
+                loop.add_callback(future.set_result, result)
+            except Exception as e:
+                LOGGER.error('SMTP: unable to send a message: %s', e)
+                self.quit(smtp)
+                smtp = None
+                loop.add_callback(future.set_exception, e)
+
+        self.quit(smtp)
+
+    @staticmethod
+    def quit(smtp):
+        if smtp is None:
+            return
+        try:
+            smtp.quit()
+        except Exception:
+            pass
@@ -2,7 +2,15 @@ import json
 from tornado import gen, httpclient
 
 from graphite_beacon.handlers import AbstractHandler, LOGGER
-from graphite_beacon.template import TEMPLATES
+from graphite_beacon.events import Event
+from graphite_beacon.utils import parse_interval
+
+# Backoff after failed polls (seconds)
+MIN_BACKOFF = 1
+MAX_BACKOFF = 300
+
+# The poll's request timeout is the server-side timeout plus this (seconds)
+REQUEST_TIMEOUT_MARGIN = 10
 
 
 class TelegramHandler(AbstractHandler):
@@ -12,7 +20,8 @@ class TelegramHandler(AbstractHandler):
     # Default options
     defaults = {
         'token': None,
-        'bot_ident': None
+        'bot_ident': None,
+        'poll_timeout': '50second',
     }
 
     def init_handler(self):
@@ -27,51 +36,53 @@ class TelegramHandler(AbstractHandler):
         self.url = "https://api.telegram.org/bot%s/" % (self.token)
 
         self._chats = []
+        self._stopped = False
         self._listen_commands()
 
-    def get_message(self, level, alert, value, target=None, ntype=None, rule=None):
-
+    def get_message(self, level, alert, value, target=None, ntype=None, rule=None, event=None):
+        if event is None:
+            event = Event(level, alert, value, target, ntype, rule)
         msg_type = 'telegram' if ntype == 'graphite' else 'short'
-        tmpl = TEMPLATES[ntype][msg_type]
-        return tmpl.generate(
-            level=level, reactor=self.reactor, alert=alert, value=value, target=target).strip()
+        return event.render(msg_type, self.reactor)
 
     @gen.coroutine
     def _listen_commands(self):
+        """Long-poll the bot's updates, one request at a time."""
 
         self._last_update = None
+        poll_timeout = int(parse_interval(self.options['poll_timeout']) / 1000)
+        backoff = 0
 
-        update_body = {"timeout": 2}
-
-        update_headers = {"Content-Type": "application/json"}
-
-        while True:
+        while not self._stopped:
+            update_body = {"timeout": poll_timeout}
             if self._last_update:
-                update_body.update({"offset": self._last_update + 1})
-            update_resp = self.client.fetch(
-                self.url + "getUpdates", headers=update_headers,
-                body=json.dumps(update_body), method="POST")
-            update_resp.add_done_callback(self._respond_commands)
-            yield gen.sleep(5)
+                update_body["offset"] = self._last_update + 1
+
+            try:
+                update_resp = yield self.client.fetch(
+                    self.url + "getUpdates", body=json.dumps(update_body), method="POST",
+                    headers={"Content-Type": "application/json"},
+                    request_timeout=poll_timeout + REQUEST_TIMEOUT_MARGIN)
+                yield self._respond_commands(json.loads(update_resp.body))
+                backoff = 0
+            except Exception as e:
+                backoff = min(backoff * 2 or MIN_BACKOFF, MAX_BACKOFF)
+                LOGGER.error("Handler (%s) failed to get updates, retry in %ss: %s",
+                             self.name, backoff, e)
+                yield gen.sleep(backoff)
+
+    def stop(self):
+        self._stopped = True
 
     @gen.coroutine
-    def _respond_commands(self, update_response):
-
-        if update_response.exception():
-            LOGGER.error(str(update_response.exception()))
-
-        update_content = update_response.result().body
-        if not update_content:
-            return
-        else:
-            update_content = json.loads(update_content)
+    def _respond_commands(self, update_content):
 
         for update in update_content["result"]:
-            if not update["message"].get('text'):
+            self._last_update = update["update_id"]
+            if not update.get("message", {}).get('text'):
                 continue
             message = update["message"]["text"].encode("utf-8")
             msp = message.split()
-            self._last_update = update["update_id"]
             if len(msp) > 1 and msp[0].startswith("/activate"):
                 try:
                     chat_id = update["message"]["chat"]["id"]
@@ -105,7 +116,27 @@ class TelegramHandler(AbstractHandler):
         LOGGER.debug("Handler (%s) %s", self.name, level)
 
         message = self.get_message(level, *args, **kwargs)
-        for chat in self._chats:
+        yield self.send(message)
+
+    def notify_many(self, events):
+        LOGGER.debug("Handler (%s) digest of %d events", self.name, len(events))
+        return self.send(self.get_digest(events))
+
+    @gen.coroutine
+    def send(self, message):
+        """Send the message to all the activated chats at once.
+
+        A failed chat fails the delivery, so it is retried (the spool sends the message to all
+        the chats again).
+        """
+        yield [self.send_to(chat, message) for chat in self._chats]
+
+    @gen.coroutine
+    def send_to(self, chat, message):
+        try:
             yield self.client.fetch(
                 self.url + "sendMessage", body=json.dumps({"chat_id": chat, "text": message}),
                 method="POST", headers={"Content-Type": "application/json"})
+        except Exception as e:
+            LOGGER.error("Handler (%s) failed to send to chat %s: %s", self.name, chat, e)
+            raise
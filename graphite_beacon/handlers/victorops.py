@@ -23,15 +23,41 @@ class VictorOpsHandler(AbstractHandler):
         self.client = hc.AsyncHTTPClient()
 
     @gen.coroutine
-    def notify(self, level, alert, value, target=None, ntype=None, rule=None):
+    def notify(self, level, alert, value, target=None, ntype=None, rule=None, event=None):
         LOGGER.debug("Handler (%s) %s", self.name, level)
 
-        message = self.get_short(level, alert, value, target=target, ntype=ntype, rule=rule)
+        message = self.get_short(
+            level, alert, value, target=target, ntype=ntype, rule=rule, event=event)
         data = {'entity_display_name': alert.name, 'state_message': message, 'message_type': level}
         if target:
             data['target'] = target
         if rule:
             data['rule'] = rule['raw']
+        yield self.send(data)
+
+    @gen.coroutine
+    def notify_many(self, events):
+        """ Send a digest per level. """
+        LOGGER.debug("Handler (%s) digest of %d events", self.name, len(events))
+        levels = {}
+        for event in events:
+            levels.setdefault(event.level, []).append(event)
+
+        yield [self.send_digest(level, events) for level, events in levels.items()]
+
+    def send_digest(self, level, events):
+        if len(events) == 1:
+            args, kwargs = events[0].args
+            return self.notify(*args, **kwargs)
+        return self.send({
+            'entity_display_name': events[0].alert.name,
+            'state_message': self.get_digest(events),
+            'message_type': level,
+            'targets': [event.target for event in events],
+        })
+
+    @gen.coroutine
+    def send(self, data):
         body = json.dumps(data)
         headers = {'Content-Type': 'application/json;'}
         yield self.client.fetch(self.url, method="POST", body=body, headers=headers)
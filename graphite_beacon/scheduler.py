@@ -0,0 +1,90 @@
+"""Run alerts' checks from a single timer."""
+
+import heapq
+import logging
+import zlib
+from itertools import count
+
+from tornado import ioloop
+
+LOGGER = logging.getLogger('graphite-beacon')
+
+
+class Scheduler(object):
+
+    """Spread alerts evenly across their intervals.
+
+    Every alert gets a phase offset derived from its name, so an alert always fires at the same
+    point of its interval (also after restarts and reloads) and alerts with the same interval
+    don't hit Graphite at the same moment. All alerts are fired from one IOLoop timeout.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.jobs = {}
+        self.counter = count()
+        self.timeout = None
+        self.deadline = None
+
+    @staticmethod
+    def phase(alert, interval):
+        """Get the alert's offset inside the interval (seconds)."""
+        return zlib.crc32(alert.name.encode('utf-8')) % int(interval * 1000) / 1000.0
+
+    def add(self, alert, interval):
+        """Schedule the alert's load every interval (ms)."""
+        self.remove(alert)
+        interval /= 1000.0
+        now = ioloop.IOLoop.current().time()
+        phase = self.phase(alert, interval)
+        deadline = now - (now - phase) % interval + interval
+        job = [deadline, next(self.counter), alert, interval]
+        self.jobs[alert] = job
+        heapq.heappush(self.heap, job)
+        self.reschedule()
+
+    def remove(self, alert):
+        """Unschedule the alert."""
+        job = self.jobs.pop(alert, None)
+        if job is not None:
+            # Removed lazily when it reaches the top of the heap
+            job[2] = None
+
+    def stop(self):
+        for alert in list(self.jobs):
+            self.remove(alert)
+        if self.timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self.timeout)
+        self.timeout = self.deadline = None
+
+    def reschedule(self):
+        """Set the timer to the nearest job."""
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.timeout is not None:
+            if self.deadline <= deadline:
+                return
+            ioloop.IOLoop.current().remove_timeout(self.timeout)
+        self.deadline = deadline
+        self.timeout = ioloop.IOLoop.current().add_timeout(deadline, self.run)
+
+    def run(self):
+        """Fire the alerts which are due."""
+        self.timeout = self.deadline = None
+        now = ioloop.IOLoop.current().time()
+        while self.heap and self.heap[0][0] <= now:
+            job = heapq.heappop(self.heap)
+            alert = job[2]
+            if alert is None:
+                continue
+            try:
+                alert.load()
+            except Exception as e:
+                LOGGER.exception(e)
+            # Skip the runs which were missed
+            job[0] += job[3] * ((now - job[0]) // job[3] + 1)
+            heapq.heappush(self.heap, job)
+        self.reschedule()
@@ -0,0 +1,206 @@
+"""Run alerts in several worker processes.
+
+The supervisor forks the workers and runs the handlers. Every worker checks its share of the
+alerts (by consistent hashing of their names) and sends its events to the supervisor through
+a pipe, so digests, queues and rate limits of the handlers stay global.
+"""
+
+import bisect
+import json
+import logging
+import os
+import signal
+import zlib
+
+from tornado import ioloop, iostream
+
+from .events import Event
+
+LOGGER = logging.getLogger('graphite-beacon')
+
+# Points of every worker on the hash ring
+REPLICAS = 100
+
+# Delay before a dead worker is started again (seconds)
+RESPAWN_DELAY = 1.0
+
+
+def _hash(key):
+    return zlib.crc32(key.encode('utf-8')) & 0xffffffff
+
+
+class HashRing(object):
+
+    """Consistent hashing of names to nodes.
+
+    When the number of nodes changes only about 1/N of the names move to other nodes.
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.ring = sorted(
+            (_hash('%s:%s' % (node, num)), node) for node in range(nodes)
+            for num in range(replicas))
+        self.keys = [key for key, _ in self.ring]
+
+    def get(self, name):
+        pos = bisect.bisect(self.keys, _hash(name)) % len(self.keys)
+        return self.ring[pos][1]
+
+
+class Shard(object):
+
+    """The part of the alerts checked by a process (index None is the supervisor)."""
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.ring = HashRing(count)
+
+    def owns(self, name):
+        return self.ring.get(name) == self.index
+
+
+class Upstream(object):
+
+    """Send a worker's events to the supervisor.
+
+    The events of an IOLoop iteration (i.e. of one check) are sent as one line, so the
+    supervisor collects them into the same digests.
+    """
+
+    def __init__(self, reactor, fd):
+        self.reactor = reactor
+        self.stream = iostream.PipeIOStream(fd)
+        self.stream.set_close_callback(self.on_close)
+        self.pending = []
+
+    def send(self, event):
+        if not self.pending:
+            ioloop.IOLoop.current().add_callback(self.flush)
+        self.pending.append(event.dump())
+
+    def flush(self):
+        events, self.pending = self.pending, []
+        if events and not self.stream.closed():
+            self.stream.write(json.dumps(events, default=str).encode('utf-8') + b'\n')
+
+    def on_close(self):
+        LOGGER.error('The supervisor has gone, stop the worker')
+        self.reactor.stop()
+
+
+class Supervisor(object):
+
+    """Fork the workers, restart them when they die and route their notifications."""
+
+    def __init__(self, count, **options):
+        self.count = count
+        self.options = options
+        self.workers = {}
+        self.reactor = None
+        self.alerts = {}
+        self.stopping = False
+
+    def start(self):
+        # Workers are forked before the supervisor's IOLoop is created
+        for index in range(self.count):
+            self.spawn(index)
+
+        from .core import Reactor
+        self.reactor = Reactor(shard=Shard(None, self.count), **self.options)
+        self.index_alerts()
+        for index in self.workers:
+            self.listen(index)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reinit)
+        self.reactor.start()
+
+    def spawn(self, index):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(rfd)
+            for _, fd, _ in self.workers.values():
+                os.close(fd)
+            try:
+                self.run_worker(index, wfd)
+            finally:
+                os._exit(0)
+
+        os.close(wfd)
+        self.workers[index] = (pid, rfd, None)
+        LOGGER.info('Worker %d has started (pid %d)', index, pid)
+
+    def run_worker(self, index, fd):
+        # A respawned worker is forked from the running IOLoop, leave it to the supervisor
+        ioloop.IOLoop.clear_current()
+        ioloop.IOLoop.clear_instance()
+        ioloop.IOLoop().install()
+
+        from .core import Reactor
+        reactor = Reactor(shard=Shard(index, self.count), **dict(self.options, pidfile=None))
+        reactor.upstream = Upstream(reactor, fd)
+
+        signal.signal(signal.SIGTERM, reactor.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, reactor.reinit)
+        reactor.start()
+
+    def listen(self, index):
+        pid, fd, _ = self.workers[index]
+        stream = iostream.PipeIOStream(fd)
+        self.workers[index] = (pid, fd, stream)
+        stream.set_close_callback(lambda: self.on_close(index))
+
+        def read(line):
+            self.route(line)
+            if not stream.closed():
+                stream.read_until(b'\n', read)
+
+        stream.read_until(b'\n', read)
+
+    def index_alerts(self):
+        self.alerts = dict((alert.name, alert) for alert in self.reactor.alerts)
+
+    def route(self, line):
+        """Pass a batch of a worker's events to the handlers."""
+        for record in json.loads(line.decode('utf-8')):
+            alert = self.alerts.get(record['alert'])
+            if alert is None:
+                LOGGER.warn('Unknown alert from a worker: %s', record['alert'])
+                continue
+            self.reactor.publish(Event.load(record, alert))
+
+    def on_close(self, index):
+        pid, _, _ = self.workers.pop(index)
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        if self.stopping:
+            return
+        LOGGER.error('Worker %d (pid %d) has died, restart it', index, pid)
+        loop = ioloop.IOLoop.current()
+        loop.add_timeout(loop.time() + RESPAWN_DELAY, self.respawn, index)
+
+    def respawn(self, index):
+        if not self.stopping:
+            self.spawn(index)
+            self.listen(index)
+
+    def reinit(self, *args):
+        self.reactor.reinit()
+        self.index_alerts()
+        for pid, _, _ in self.workers.values():
+            os.kill(pid, signal.SIGHUP)
+
+    def stop(self, *args):
+        self.stopping = True
+        for pid, _, _ in self.workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.reactor.stop()
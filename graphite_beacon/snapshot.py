@@ -0,0 +1,151 @@
+"""Save alerts' states and histories so a restarted reactor resumes where it has stopped."""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from tornado import ioloop
+
+from .store import TargetStore, UNKNOWN
+from .utils import parse_interval
+
+LOGGER = logging.getLogger('graphite-beacon')
+
+MAGIC = b'graphite-beacon snapshot 2\n'
+
+
+class Snapshot(object):
+
+    """Periodic snapshot of the alerts' states and histories.
+
+    The file is the magic line, a JSON index line and the arrays of every alert's target store
+    as raw blocks in the order of the index. The blocks are copied on the IOLoop and written
+    by a thread to a temporary file which replaces the old snapshot, so a crash never leaves a
+    partial snapshot behind.
+
+    The snapshot is enabled with the `snapshot` option (path to the file).
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.path = None
+        self.callback = None
+        self.writer = None
+
+    def configure(self, path):
+        """Start saving to the path. Returns True when the path has changed."""
+        if path == self.path:
+            return False
+        self.stop()
+        self.path = path
+        if path:
+            self.callback = ioloop.PeriodicCallback(
+                self.save, parse_interval(self.reactor.options['snapshot_interval']))
+            self.callback.start()
+        return True
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+
+    @staticmethod
+    def key(alert):
+        return '%s:%s:%s' % (alert.source, alert.name, alert.query)
+
+    def save(self, wait=False):
+        """Write the snapshot of all the alerts, in background unless `wait` is set."""
+        if not self.path:
+            return
+
+        if self.writer is not None and self.writer.is_alive():
+            if not wait:
+                LOGGER.warn('Snapshot %s: the previous one is still being written', self.path)
+                return
+            self.writer.join()
+
+        index, chunks = [], []
+        for alert in filter(self.reactor.owns, self.reactor.alerts):
+            meta, blocks = alert.store.dump()
+            index.append({'key': self.key(alert), 'store': meta,
+                          'bytes': sum(len(block) for block in blocks)})
+            chunks.extend(blocks)
+        chunks.insert(0, json.dumps(index).encode('utf-8') + b'\n')
+
+        if wait:
+            self.write(self.path, chunks)
+            return
+        self.writer = threading.Thread(
+            target=self.write, args=(self.path, chunks), name='beacon-snapshot')
+        self.writer.daemon = True
+        self.writer.start()
+
+    @staticmethod
+    def write(path, chunks):
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as snapshot:
+                snapshot.write(MAGIC)
+                for chunk in chunks:
+                    snapshot.write(chunk)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            LOGGER.error('Unable to save snapshot %s: %s', path, e)
+            return
+        LOGGER.debug('Snapshot saved: %s', path)
+
+    def restore(self):
+        """Load the states and histories of the alerts from the snapshot."""
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'rb') as snapshot:
+                if snapshot.readline() != MAGIC:
+                    raise ValueError('Unknown format')
+                index = json.loads(snapshot.readline().decode('utf-8'))
+                data = snapshot.read()
+        except (IOError, ValueError) as e:
+            LOGGER.error('Invalid snapshot %s: %s', self.path, e)
+            return
+
+        alerts = dict(
+            (self.key(alert), alert) for alert in filter(self.reactor.owns, self.reactor.alerts))
+        offset = restored = 0
+        now = time.time()
+        for entry in index:
+            alert = alerts.get(entry['key'])
+            block, offset = data[offset:offset + entry['bytes']], offset + entry['bytes']
+            if alert is None:
+                continue
+            try:
+                targets = self.load(alert, entry['store'], block)
+            except ValueError as e:
+                LOGGER.error('Snapshot %s: unable to restore %s: %s', self.path, alert.name, e)
+                continue
+            # Restored targets which don't show up again expire after `target_ttl`
+            for target in targets:
+                alert.last_seen[target] = now
+            restored += len(targets)
+
+        LOGGER.info('Snapshot %s: restored %d targets', self.path, restored)
+
+    @staticmethod
+    def load(alert, meta, data):
+        """Load the alert's store from its blocks. Returns the restored targets."""
+        if not alert.store and alert.store.size == meta['size']:
+            alert.store.restore(meta, data)
+            return list(alert.store)
+
+        # The history size has changed (or the alert is running), copy target by target
+        store = TargetStore(meta['size'])
+        store.restore(meta, data)
+        for target, slot in store.slots.items():
+            if store.levels[slot] != UNKNOWN:
+                alert.state[target] = store.level_names[store.levels[slot]]
+            alert.history[target].extend(store.views[slot])
+        return list(store)
@@ -0,0 +1,178 @@
+"""Keep notifications on disk until the handlers have delivered them."""
+
+import json
+import logging
+import os
+
+from tornado import ioloop
+
+from .events import Event
+from .utils import parse_interval
+
+LOGGER = logging.getLogger('graphite-beacon')
+
+# The log is truncated when nothing is pending and it has more lines than this
+COMPACT_LINES = 1000
+
+
+class Spool(object):
+
+    """Append-only log of pending deliveries.
+
+    Every delivery of an event to a handler is written as an `add` record and is acknowledged
+    with an `ack` record when the handler has succeeded or the retries are exhausted. Failed
+    deliveries are retried with exponential backoff, and the records which are not acknowledged
+    are delivered again after a restart. Records are fsynced in batches every `spool_fsync`.
+
+    The spool is enabled with the `spool` option (path to the log).
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.path = None
+        self.file = None
+        self.entries = {}
+        self.next_id = 1
+        self.lines = 0
+        self.sync_timeout = None
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def open(self, path):
+        """Open the log and load the pending records. Returns True when the log was opened."""
+        if path == self.path:
+            return False
+        self.close()
+        self.path = path
+        if not path:
+            return False
+
+        records = {}
+        if os.path.exists(path):
+            with open(path) as log:
+                for line in log:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The tail of a record which was being written on a crash
+                        continue
+                    if record['op'] == 'add':
+                        records[record['id']] = record
+                    else:
+                        records.pop(record['id'], None)
+                    self.next_id = max(self.next_id, record['id'] + 1)
+
+        # Rewrite the log with the pending records only
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as log:
+            for _, record in sorted(records.items()):
+                log.write(json.dumps(record) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        os.rename(tmp, path)
+
+        self.file = open(path, 'a')
+        self.lines = len(records)
+        self.entries = dict(
+            (id_, {'handler': record['handler'], 'event': record['event'], 'attempts': 0})
+            for id_, record in records.items())
+        LOGGER.info('Spool %s: %d pending deliveries', path, len(records))
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+        self.file = self.path = None
+        self.entries = {}
+
+    def replay(self):
+        """Deliver the records loaded from the log."""
+        for id_ in sorted(self.entries):
+            self.retry(id_)
+
+    def track(self, handler, events):
+        """Record the deliveries of the events to the handler. Returns the records' IDs."""
+        if not self.enabled:
+            return ()
+        ids = []
+        for event in events:
+            id_, self.next_id = self.next_id, self.next_id + 1
+            self.entries[id_] = {'handler': handler.name, 'event': event, 'attempts': 0}
+            self.write(
+                {'op': 'add', 'id': id_, 'handler': handler.name, 'event': event.dump()})
+            ids.append(id_)
+        return ids
+
+    def done(self, ids):
+        """Acknowledge the deliveries."""
+        for id_ in ids:
+            if self.entries.pop(id_, None) is not None:
+                self.write({'op': 'ack', 'id': id_})
+
+    def failed(self, ids):
+        """Schedule the failed deliveries to be retried."""
+        loop = ioloop.IOLoop.current()
+        backoff = parse_interval(self.reactor.options['spool_backoff']) / 1000.0
+        for id_ in ids:
+            entry = self.entries.get(id_)
+            if entry is None:
+                continue
+            entry['attempts'] += 1
+            if entry['attempts'] > self.reactor.options['spool_retries']:
+                LOGGER.error('Handler "%s": give up a delivery after %d attempts',
+                             entry['handler'], entry['attempts'])
+                self.done([id_])
+                continue
+            delay = backoff * 2 ** (entry['attempts'] - 1)
+            loop.add_timeout(loop.time() + delay, self.retry, id_)
+
+    def retry(self, id_):
+        entry = self.entries.get(id_)
+        if entry is None:
+            return
+
+        handler = self.get_handler(entry['handler'])
+        event = entry['event']
+        if not isinstance(event, Event):
+            event = entry['event'] = self.load_event(event)
+        if handler is None or event is None:
+            LOGGER.warn('Spool: drop a delivery to "%s", the handler or alert is gone',
+                        entry['handler'])
+            return self.done([id_])
+
+        args, kwargs = event.args
+        self.reactor.dispatcher.submit(handler, handler.notify, args, kwargs, ids=(id_,))
+
+    def get_handler(self, name):
+        for handlers in self.reactor.handlers.values():
+            for handler in handlers:
+                if handler.name == name:
+                    return handler
+
+    def load_event(self, record):
+        for alert in self.reactor.alerts:
+            if alert.name == record['alert']:
+                return Event.load(record, alert)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=str) + '\n')
+        self.lines += 1
+        if self.sync_timeout is None:
+            loop = ioloop.IOLoop.current()
+            delay = parse_interval(self.reactor.options['spool_fsync']) / 1000.0
+            self.sync_timeout = loop.add_timeout(loop.time() + delay, self.sync)
+
+    def sync(self):
+        """Flush the written records to the disk."""
+        if self.sync_timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self.sync_timeout)
+            self.sync_timeout = None
+
+        self.file.flush()
+        if not self.entries and self.lines > COMPACT_LINES:
+            self.file.truncate(0)
+            self.lines = 0
+        os.fsync(self.file.fileno())
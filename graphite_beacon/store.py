@@ -0,0 +1,307 @@
+"""Columnar storage of alerts' targets."""
+
+import math
+from array import array
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+# States of the alert itself, they are kept apart from the targets
+INTERNAL_TARGETS = None, 'waiting', 'loading'
+
+UNKNOWN = -1
+
+# Arrays of a store, in the order of their blocks in a dump
+ARRAYS = 'levels', 'counts', 'heads', 'evicted', 'sums', 'values'
+
+
+def tobytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+def frombytes(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+
+class TargetStore(object):
+
+    """Targets of an alert interned to integer slots.
+
+    A slot holds the target's level code and its history: a ring of `size` values in one flat
+    array of doubles, with the running sum of the values. Slots of the forgotten targets are
+    reused. `history` and `state` give dict-like views of the store.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.slots = {}
+        self.targets = []
+        self.views = []
+        self.free = []
+        self.levels = array('b')
+        self.counts = array('l')
+        self.heads = array('l')
+        self.evicted = array('l')
+        self.sums = array('d')
+        self.values = array('d')
+        self.level_codes = {}
+        self.level_names = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def intern(self, target):
+        """Get the target's slot, allocating one for a new target."""
+        slot = self.slots.get(target)
+        if slot is not None:
+            return slot
+
+        if self.free:
+            slot = self.free.pop()
+            self.targets[slot] = target
+            self.levels[slot] = UNKNOWN
+            self.counts[slot] = self.heads[slot] = self.evicted[slot] = 0
+            self.sums[slot] = 0.0
+        else:
+            slot = len(self.targets)
+            self.targets.append(target)
+            self.views.append(HistoryView(self, slot))
+            self.levels.append(UNKNOWN)
+            self.counts.append(0)
+            self.heads.append(0)
+            self.evicted.append(0)
+            self.sums.append(0.0)
+            self.values.extend([0.0] * self.size)
+        self.slots[target] = slot
+        return slot
+
+    def release(self, slot):
+        """Free the slot when the target has neither a level nor a history."""
+        if self.levels[slot] == UNKNOWN and not self.counts[slot]:
+            del self.slots[self.targets[slot]]
+            self.targets[slot] = None
+            self.free.append(slot)
+
+    def level_code(self, level):
+        code = self.level_codes.get(level)
+        if code is None:
+            code = self.level_codes[level] = len(self.level_names)
+            self.level_names.append(level)
+        return code
+
+    def dump(self):
+        """Get the description of the store and its arrays as blocks of bytes."""
+        blocks, arrays = [], []
+        for name in ARRAYS:
+            values = getattr(self, name)
+            blocks.append(tobytes(values))
+            arrays.append([name, values.typecode, values.itemsize, len(blocks[-1])])
+        meta = {'size': self.size, 'targets': list(self.targets),
+                'levels': list(self.level_names), 'arrays': arrays}
+        return meta, blocks
+
+    def restore(self, meta, data):
+        """Load a dump into the empty store of the same size."""
+        assert not self.targets and self.size == meta['size'], 'Store is not empty'
+        offset = 0
+        for name, typecode, itemsize, length in meta['arrays']:
+            if array(typecode).itemsize != itemsize:
+                raise ValueError('Incompatible array: %s' % name)
+            setattr(self, name, frombytes(typecode, data[offset:offset + length]))
+            offset += length
+
+        self.targets = meta['targets']
+        self.slots = dict(
+            (target, slot) for slot, target in enumerate(self.targets) if target is not None)
+        self.free = [slot for slot, target in enumerate(self.targets) if target is None]
+        self.views = [HistoryView(self, slot) for slot in range(len(self.targets))]
+        self.level_names = meta['levels']
+        self.level_codes = dict((level, code) for code, level in enumerate(self.level_names))
+
+    def fill_levels(self, level):
+        """Set the level of all the targets which have one."""
+        code = self.level_code(level)
+        self.levels = array('b', (UNKNOWN if c == UNKNOWN else code for c in self.levels))
+
+
+class HistoryView(object):
+
+    """History of one target, a bounded deque of floats with the running sum."""
+
+    __slots__ = 'store', 'slot'
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+
+    def __len__(self):
+        return self.store.counts[self.slot]
+
+    def __iter__(self):
+        store, size = self.store, self.store.size
+        base, head = self.slot * size, store.heads[self.slot]
+        for num in range(store.counts[self.slot]):
+            yield store.values[base + (head + num) % size]
+
+    def __getitem__(self, index):
+        """Get a value or a list of the values of a slice."""
+        return list(self)[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'HistoryView(%r)' % list(self)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    @property
+    def sum(self):
+        return self.store.sums[self.slot]
+
+    @property
+    def average(self):
+        count = self.store.counts[self.slot]
+        return self.store.sums[self.slot] / count if count else None
+
+    def append(self, value):
+        store, slot, size = self.store, self.slot, self.store.size
+        if not size:
+            return
+        value = float(value)
+        count, head = store.counts[slot], store.heads[slot]
+        if count < size:
+            store.values[slot * size + (head + count) % size] = value
+            store.counts[slot] = count + 1
+            store.sums[slot] += value
+            return
+
+        position = slot * size + head
+        store.sums[slot] += value - store.values[position]
+        store.values[position] = value
+        store.heads[slot] = (head + 1) % size
+        store.evicted[slot] += 1
+        if store.evicted[slot] >= size:
+            self.resum()
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def clear(self):
+        store, slot = self.store, self.slot
+        store.counts[slot] = store.heads[slot] = store.evicted[slot] = 0
+        store.sums[slot] = 0.0
+
+    def resum(self):
+        """Recompute the sum to drop the accumulated float errors."""
+        self.store.sums[self.slot] = math.fsum(self)
+        self.store.evicted[self.slot] = 0
+
+
+class HistoryMap(MutableMapping):
+
+    """Histories of the targets, works like a `defaultdict` of deques."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, target):
+        return self.store.views[self.store.intern(target)]
+
+    def __setitem__(self, target, values):
+        history = self[target]
+        if values is not history:
+            values = list(values)
+            history.clear()
+            history.extend(values)
+
+    def __delitem__(self, target):
+        slot = self.store.slots[target]
+        self.store.views[slot].clear()
+        self.store.release(slot)
+
+    def __contains__(self, target):
+        return target in self.store.slots
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def get(self, target, default=None):
+        slot = self.store.slots.get(target)
+        return default if slot is None else self.store.views[slot]
+
+    def pop(self, target, default=None):
+        if target not in self.store.slots:
+            return default
+        values = list(self[target])
+        del self[target]
+        return values
+
+
+class StateMap(MutableMapping):
+
+    """Levels of the targets. The alert's own states are kept in a dict."""
+
+    def __init__(self, store, internal):
+        self.store = store
+        self.internal = dict(internal)
+
+    def __getitem__(self, target):
+        if target in INTERNAL_TARGETS:
+            return self.internal[target]
+        slot = self.store.slots.get(target)
+        code = UNKNOWN if slot is None else self.store.levels[slot]
+        if code == UNKNOWN:
+            raise KeyError(target)
+        return self.store.level_names[code]
+
+    def __setitem__(self, target, level):
+        if target in INTERNAL_TARGETS:
+            self.internal[target] = level
+        else:
+            self.store.levels[self.store.intern(target)] = self.store.level_code(level)
+
+    def __delitem__(self, target):
+        if target in INTERNAL_TARGETS:
+            del self.internal[target]
+            return
+        slot = self.store.slots.get(target)
+        if slot is None or self.store.levels[slot] == UNKNOWN:
+            raise KeyError(target)
+        self.store.levels[slot] = UNKNOWN
+        self.store.release(slot)
+
+    def __iter__(self):
+        for target in self.internal:
+            yield target
+        levels = self.store.levels
+        for target, slot in list(self.store.slots.items()):
+            if levels[slot] != UNKNOWN:
+                yield target
+
+    def __len__(self):
+        return len(self.internal) + sum(1 for code in self.store.levels if code != UNKNOWN)
+
+    def fill(self, level):
+        """Set the level of the alert and of all its targets."""
+        for target in self.internal:
+            self.internal[target] = level
+        self.store.fill_levels(level)
@@ -17,6 +17,16 @@ TEMPLATES = {
         'text': LOADER.load('url/message.txt'),
         'short': LOADER.load('url/short.txt'),
     },
+    'digest': {
+        'html': LOADER.load('digest/message.html'),
+        'text': LOADER.load('digest/message.txt'),
+        'short': LOADER.load('digest/short.txt'),
+    },
+    'disappeared': {
+        'html': LOADER.load('common/message.html'),
+        'text': LOADER.load('common/message.txt'),
+        'short': LOADER.load('disappeared/short.txt'),
+    },
     'common': {
         'html': LOADER.load('common/message.html'),
         'text': LOADER.load('common/message.txt'),
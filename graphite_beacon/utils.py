@@ -150,3 +150,63 @@ def parse_rule(rule):
         result['exprs'].extend([logical_operator, _parse_expr(expr)])
 
     return result
+
+
+def _compile_expr(expr, history_size):
+    cond, rvalue, mod = expr['op'], expr['value'], expr['mod']
+    if rvalue != HISTORICAL:
+        rvalue = mod(rvalue)
+        return lambda value, history: cond(value, rvalue)
+
+    def evaluate(value, history):
+        # Historical expressions are ignored until the history is full
+        if len(history) < history_size:
+            return False
+        return cond(value, mod(history.average))
+
+    return evaluate
+
+
+def _combine(lhs, logical_operator, rhs):
+    if logical_operator is LOGICAL_OPERATORS['AND']:
+        return lambda value, history: lhs(value, history) and rhs(value, history)
+    return lambda value, history: lhs(value, history) or rhs(value, history)
+
+
+def compile_rule(rule, history_size):
+    """ Compile a parsed rule into a function of (value, history).
+
+    Expressions are folded from left to right with short-circuiting logical operators,
+    constant modifiers are applied once here. `history` should provide `average`.
+    """
+    exprs = rule['exprs']
+    evaluate = _compile_expr(exprs[0], history_size)
+    for logical_operator, expr in zip(exprs[1::2], exprs[2::2]):
+        evaluate = _combine(evaluate, logical_operator, _compile_expr(expr, history_size))
+    return evaluate
+
+
+def _compile_array_expr(expr):
+    cond, rvalue, mod = expr['op'], expr['value'], expr['mod']
+    if rvalue != HISTORICAL:
+        rvalue = mod(rvalue)
+        return lambda values, averages, full: cond(values, rvalue)
+    return lambda values, averages, full: full & cond(values, mod(averages))
+
+
+def _combine_array(lhs, logical_operator, rhs):
+    return lambda values, averages, full: logical_operator(
+        lhs(values, averages, full), rhs(values, averages, full))
+
+
+def compile_rule_array(rule):
+    """ Compile a parsed rule into a function of NumPy arrays.
+
+    The function takes arrays of values, historical averages and flags of full histories
+    and returns a boolean mask of the values matching the rule.
+    """
+    exprs = rule['exprs']
+    evaluate = _compile_array_expr(exprs[0])
+    for logical_operator, expr in zip(exprs[1::2], exprs[2::2]):
+        evaluate = _combine_array(evaluate, logical_operator, _compile_array_expr(expr))
+    return evaluate
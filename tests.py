@@ -303,3 +303,1035 @@ def test_html_template(reactor):
     assert message
 
     assert len(message._payload) == 2
+
+
+def test_graphite_batch(reactor):
+    from tornado import concurrent, escape, gen, ioloop
+    from graphite_beacon.alerts import BaseAlert
+
+    reactor.options['batch_size'] = 10
+    alert1 = BaseAlert.get(reactor, name='CPU', query='*.cpu', rules=["warning: > 10"])
+    alert2 = BaseAlert.get(reactor, name='MEM', query='*.mem', rules=["warning: > 10"])
+
+    def fetch(url, streaming_callback=None, **kwargs):
+        streaming_callback(b'beacon-1~host.mem,0,120,60|5.0,7.0\nbeacon-0~host.')
+        streaming_callback(b'cpu,0,120,60|1.0,3.0\n')
+        future = concurrent.Future()
+        future.set_result(mock.Mock())
+        return future
+
+    @gen.coroutine
+    def load():
+        result = yield [alert1.fetch(), alert2.fetch()]
+        raise gen.Return(result)
+
+    with mock.patch.object(alert1.client, 'fetch', side_effect=fetch) as fetch:
+        records1, records2 = ioloop.IOLoop.current().run_sync(load)
+
+    assert fetch.call_count == 1
+    body = escape.url_unescape(fetch.call_args[1]['body'])
+    assert 'target=aliasSub(*.cpu, "^", "beacon-0~")' in body
+    assert 'target=aliasSub(*.mem, "^", "beacon-1~")' in body
+
+    assert [(r.target, r.average) for r in records1] == [('host.cpu', 2.0)]
+    assert [(r.target, r.average) for r in records2] == [('host.mem', 6.0)]
+
+    # A failed batch is loaded again query by query, only the broken alert fails
+    from tornado.httpclient import HTTPError
+
+    def fetch_broken(url, streaming_callback=None, **kwargs):
+        future = concurrent.Future()
+        if 'body' in kwargs or 'mem' in url:
+            future.set_exception(HTTPError(500))
+        else:
+            streaming_callback(b'host.cpu,0,120,60|1.0,3.0\n')
+            future.set_result(mock.Mock())
+        return future
+
+    @gen.coroutine
+    def load_broken():
+        futures = [alert1.fetch(), alert2.fetch()]
+        records = yield futures[0]
+        try:
+            yield futures[1]
+        except HTTPError as e:
+            raise gen.Return((records, e))
+
+    with mock.patch.object(alert1.client, 'fetch', side_effect=fetch_broken) as fetch:
+        records1, error = ioloop.IOLoop.current().run_sync(load_broken)
+
+    assert fetch.call_count == 3
+    assert [(r.target, r.average) for r in records1] == [('host.cpu', 2.0)]
+    assert error.code == 500
+
+    # A full batch cancels its window, the next batch waits for a window of its own
+    reactor.options.update(batch_size=2, batch_window='1second')
+    batcher = reactor.batcher
+    with mock.patch.object(batcher, 'load') as load, \
+            mock.patch.object(ioloop.IOLoop.current(), 'remove_timeout') as remove_timeout:
+        batcher.fetch(alert1)
+        batcher.fetch(alert2)
+        assert load.call_count == 1 and remove_timeout.call_count == 1
+        assert not batcher.timeouts
+        batcher.fetch(alert1)
+        assert load.call_count == 1 and len(batcher.timeouts) == 1
+        batcher.flush(list(batcher.timeouts)[0])
+
+
+def test_graphite_stream():
+    from graphite_beacon.graphite import GraphiteStream
+
+    lines = []
+    stream = GraphiteStream(lines.append)
+    stream.feed(b'a,0,120,60|1.0,')
+    assert lines == []
+    stream.feed(b'2.0\nb,0,120,60|3.0\nc,0')
+    assert lines == [b'a,0,120,60|1.0,2.0', b'b,0,120,60|3.0']
+    stream.feed(b',60,60|4.0')
+    stream.close()
+    assert lines[-1] == b'c,0,60,60|4.0'
+
+    # Bodies of error responses are skipped
+    lines = []
+    stream = GraphiteStream(lines.append)
+    stream.header('HTTP/1.1 500 Internal Server Error\r\n')
+    stream.header('Content-Type: text/html\r\n')
+    stream.feed(b'<html>\n<body>Error</body>\n')
+    stream.close()
+    assert lines == []
+    stream.header('HTTP/1.1 200 OK\r\n')
+    stream.feed(b'a,0,60,60|1.0\n')
+    assert lines == [b'a,0,60,60|1.0']
+
+
+def test_graphite_record():
+    from graphite_beacon.graphite import GraphiteRecord
+
+    record = GraphiteRecord('host.cpu,0,300,60|1.0,None,4.0,-1,3.0\n')
+    assert record.target == 'host.cpu'
+    assert (record.start_time, record.end_time, record.step) == (0, 300, 60)
+    assert list(record.values) == [1.0, 4.0, -1.0, 3.0]
+    assert not record.empty
+    assert record.sum == 7.0
+    assert record.average == 1.75
+    assert (record.min, record.max, record.last_value) == (-1.0, 4.0, 3.0)
+
+    record = GraphiteRecord('host.cpu,0,300,60|1.0,None,4.0,-1,3.0', -1, True)
+    assert list(record.values) == [1.0, 4.0, 3.0]
+    assert record.min == 1.0
+
+    assert GraphiteRecord('host.cpu,0,120,60|None,None').empty
+
+
+def test_http_pool(reactor):
+    from tornado import concurrent, gen, ioloop
+
+    reactor.options['backend_concurrency'] = 1
+    pool = reactor.client
+    responses = [concurrent.Future(), concurrent.Future()]
+
+    @gen.coroutine
+    def run():
+        with mock.patch.object(pool.client, 'fetch', side_effect=responses) as fetch:
+            first = pool.fetch('http://graphite/render/?target=a')
+            second = pool.fetch('http://graphite/render/?target=b')
+            yield gen.moment
+            assert fetch.call_count == 1
+            assert pool.waiters['graphite']
+
+            responses[0].set_result(mock.Mock(time_info={}))
+            yield first
+            yield gen.moment
+            assert fetch.call_count == 2
+
+            responses[1].set_result(mock.Mock(time_info={'queue': 0.5}))
+            yield second
+
+    ioloop.IOLoop.current().run_sync(run)
+    assert pool.active['graphite'] == 0
+    assert pool.stats['graphite']['requests'] == 2
+    assert pool.stats['graphite']['max_wait'] == 0.5
+
+    # The stats are logged with the reactor's periodic report
+    with mock.patch('graphite_beacon.core.LOGGER') as logger:
+        reactor.repeat()
+    assert mock.call('Backend requests: %s', dict(pool.stats)) in logger.info.call_args_list
+
+
+def test_scheduler(reactor):
+    from tornado import ioloop
+    from graphite_beacon.alerts import BaseAlert, GraphiteAlert
+
+    loop = ioloop.IOLoop.current()
+    scheduler = reactor.scheduler
+    alerts = [
+        BaseAlert.get(reactor, name='Test%d' % num, query='*', interval='1minute',
+                      rules=["warning: > 10"]) for num in range(3)]
+
+    with mock.patch.object(loop, 'time', return_value=6000.0):
+        for alert in alerts:
+            alert.start()
+
+    phases = [scheduler.phase(alert, 60) for alert in alerts]
+    assert len(set(phases)) == 3
+    assert all(0 <= phase < 60 for phase in phases)
+    assert scheduler.phase(alerts[0], 60) == phases[0]
+
+    deadlines = dict((job[2], job[0]) for job in scheduler.heap)
+    assert [deadlines[alert] for alert in alerts] == [6000 + phase for phase in phases]
+    assert scheduler.deadline == min(deadlines.values())
+
+    alerts[1].stop()
+    with mock.patch.object(loop, 'time', return_value=6060.0):
+        with mock.patch.object(GraphiteAlert, 'load') as load:
+            scheduler.run()
+    assert load.call_count == 2
+    assert sorted(job[0] for job in scheduler.heap if job[2]) == sorted(
+        6060 + phase for phase in (phases[0], phases[2]))
+    scheduler.stop()
+
+
+def test_graphite_window():
+    from graphite_beacon.graphite import GraphiteRecord, GraphiteWindow
+
+    window = GraphiteWindow(60, 4)
+    window.update(0, ['1', '2', 'None', '4'])
+    assert window.end_time == 240
+    record = GraphiteRecord.from_window('a', window)
+    assert (record.start_time, record.end_time) == (0, 240)
+    assert list(record.values) == [1, 2, 4]
+
+    # The overlapping points are replaced, the new ones shift the window
+    window.update(120, ['3', '4', '5'])
+    assert window.end_time == 300
+    assert list(GraphiteRecord.from_window('a', window).values) == [2, 3, 4, 5]
+
+    # A gap is filled with missing points
+    window.update(420, ['8'])
+    record = GraphiteRecord.from_window('a', window)
+    assert list(record.values) == [5, 8]
+    assert record.average == 6.5
+
+
+def test_incremental_fetch(reactor):
+    from tornado import concurrent, ioloop
+    from graphite_beacon.alerts import BaseAlert
+
+    alert = BaseAlert.get(
+        reactor, name='Test', query='*', time_window='5minute', incremental=True,
+        rules=["warning: > 10"])
+    responses = [
+        b'a,0,300,60|1.0,2.0,3.0,4.0,None\nb,0,300,60|1.0,1.0,1.0,1.0,1.0\n',
+        b'a,180,360,60|4.0,5.0,6.0\n',
+    ]
+
+    def fetch(url, streaming_callback=None, **kwargs):
+        streaming_callback(responses.pop(0))
+        future = concurrent.Future()
+        future.set_result(mock.Mock())
+        return future
+
+    loop = ioloop.IOLoop.current()
+    with mock.patch.object(alert.client, 'fetch', side_effect=fetch) as client_fetch:
+        records = loop.run_sync(alert.fetch)
+        assert 'from=-5minute' in client_fetch.call_args[0][0]
+        assert [(r.target, r.average) for r in records] == [('a', 2.5), ('b', 1.0)]
+
+        with mock.patch('time.time', return_value=370):
+            records = loop.run_sync(alert.fetch)
+        assert 'from=-240second' in client_fetch.call_args[0][0]
+        assert [(r.target, r.average) for r in records] == [('a', 4.0)]
+        assert list(alert.windows) == ['a']
+
+        # A tail with another step is not merged, the whole window is loaded again
+        responses.extend([
+            b'a,390,420,10|7.0,7.0,7.0\n',
+            b'a,120,420,60|5.0,6.0,7.0,7.0,7.0\n',
+        ])
+        with mock.patch('time.time', return_value=430):
+            records = loop.run_sync(alert.fetch)
+        assert 'from=-5minute' in client_fetch.call_args[0][0]
+        assert [(r.target, r.average) for r in records] == [('a', 6.4)]
+        assert alert.windows['a'].step == 60
+
+
+def test_fetch_cache(reactor):
+    from tornado import concurrent, gen, ioloop
+    from graphite_beacon.alerts import BaseAlert
+
+    alert1 = BaseAlert.get(reactor, name='Warning', query='*.cpu', rules=["warning: > 10"])
+    alert2 = BaseAlert.get(reactor, name='Critical', query='*.cpu', rules=["critical: > 20"])
+    alert3 = BaseAlert.get(reactor, name='Memory', query='*.mem', rules=["critical: > 20"])
+
+    def fetch(url, streaming_callback=None, **kwargs):
+        streaming_callback(b'host,0,120,60|1.0,3.0\n')
+        future = concurrent.Future()
+        ioloop.IOLoop.current().add_callback(future.set_result, mock.Mock())
+        return future
+
+    @gen.coroutine
+    def load():
+        result = yield [alert1.fetch(), alert2.fetch(), alert3.fetch()]
+        raise gen.Return(result)
+
+    with mock.patch.object(alert1.client, 'fetch', side_effect=fetch) as client_fetch:
+        records1, records2, _ = ioloop.IOLoop.current().run_sync(load)
+        assert client_fetch.call_count == 2
+        assert records1 is records2
+        assert not reactor.cache.entries
+
+        reactor.options['cache_ttl'] = '1minute'
+        ioloop.IOLoop.current().run_sync(load)
+        ioloop.IOLoop.current().run_sync(load)
+        assert client_fetch.call_count == 4
+        assert len(reactor.cache.entries) == 2
+
+
+def test_compile_rule():
+    from graphite_beacon.store import HistoryMap, TargetStore
+    from graphite_beacon.utils import compile_rule, parse_rule
+
+    evaluate = compile_rule(parse_rule('critical: > 5 AND < 10'), 2)
+    assert evaluate(8, None)
+    assert not evaluate(12, None)
+    assert not evaluate(3, None)
+
+    evaluate = compile_rule(parse_rule('warning: > historical * 1.5 OR >= 1KB'), 2)
+    history = HistoryMap(TargetStore(2))['node']
+    history.append(10)
+    assert not evaluate(20, history)
+    assert evaluate(1024, history)
+
+    history.append(10)
+    assert evaluate(20, history)
+    assert not evaluate(15, history)
+
+
+def test_vectorized_check(reactor):
+    pytest.importorskip('numpy')
+    import random
+    from graphite_beacon.alerts import BaseAlert
+
+    rules = ["critical: > 90", "warning: > historical * 1.2 AND > 50", "warning: < 5"]
+    scalar = BaseAlert.get(reactor, name='Scalar', query='*', interval='10minute',
+                           history_size='30minute', rules=rules)
+    vector = BaseAlert.get(reactor, name='Vector', query='*', interval='10minute',
+                           history_size='30minute', rules=rules)
+    reactor.options['send_initial'] = True
+
+    random.seed(42)
+    for _ in range(6):
+        records = [(None if random.random() < 0.1 else random.uniform(0, 100), 'host%d' % num)
+                   for num in range(50)]
+
+        reactor.options['vectorize_threshold'] = 0
+        with mock.patch.object(reactor, 'notify') as notify:
+            scalar.check(records)
+            expected = [(c[0][0], c[0][2], c[1]['target'], (c[1]['rule'] or {}).get('raw'))
+                        for c in notify.call_args_list]
+
+        reactor.options['vectorize_threshold'] = 10
+        with mock.patch.object(reactor, 'notify') as notify:
+            vector.check(records)
+            result = [(c[0][0], c[0][2], c[1]['target'], (c[1]['rule'] or {}).get('raw'))
+                      for c in notify.call_args_list]
+
+        assert result == expected
+        assert scalar.state == vector.state
+
+    assert scalar.history == vector.history
+
+
+def test_dispatcher(reactor):
+    from tornado import concurrent, gen, ioloop
+
+    delivered = []
+    pending = concurrent.Future()
+
+    class Handler(object):
+        name = 'test'
+
+        def notify(self, level, alert, value, **kwargs):
+            delivered.append(value)
+            if value == 1:
+                return pending
+
+    reactor.options.update(notify_queue_size=2, notify_overflow='drop_oldest')
+    handler = Handler()
+    dispatcher = reactor.dispatcher
+
+    @gen.coroutine
+    def run():
+        dispatcher.dispatch(handler, 'critical', None, 1)
+        yield gen.moment
+        assert delivered == [1]
+
+        # The first notification is being delivered, the second one is dropped
+        for value in range(2, 5):
+            dispatcher.dispatch(handler, 'critical', None, value)
+        assert dispatcher.depth() == {'test': 2}
+        assert dispatcher.queues['test'].dropped == 1
+
+        pending.set_result(None)
+        yield gen.moment
+        yield gen.moment
+        assert delivered == [1, 3, 4]
+        assert dispatcher.depth() == {'test': 0}
+
+    ioloop.IOLoop.current().run_sync(run)
+
+    reactor.options['notify_queue_size'] = 0
+    dispatcher.dispatch(handler, 'critical', None, 5)
+    assert delivered[-1] == 5
+
+
+def test_fan_out(reactor):
+    from tornado import concurrent, gen, ioloop
+
+    class Handler(object):
+
+        def __init__(self, name, result):
+            self.name, self.result = name, result
+
+        def notify(self, level, alert, value, **kwargs):
+            if isinstance(self.result, Exception):
+                raise self.result
+            return self.result
+
+    dead = Handler('dead', concurrent.Future())
+    handlers = [dead, Handler('broken', ValueError('boom')), Handler('ok', None)]
+    reactor.options.update(notify_queue_size=0, notify_timeout='100ms')
+    reactor.handlers['critical'] = handlers
+    dispatcher = reactor.dispatcher
+
+    @gen.coroutine
+    def run():
+        start = ioloop.IOLoop.current().time()
+        yield reactor.notify('critical', None, 1, target='a', ntype='common')
+        raise gen.Return(ioloop.IOLoop.current().time() - start)
+
+    assert ioloop.IOLoop.current().run_sync(run) < 1
+    assert dispatcher.stats['dead']['timeouts'] == 1
+    assert dispatcher.stats['dead']['max_time'] >= 0.1
+    assert dispatcher.stats['broken']['failed'] == 1
+    assert dispatcher.stats['ok']['sent'] == 1
+
+
+def test_digest(reactor):
+    from tornado import gen, ioloop
+    from graphite_beacon.alerts import BaseAlert
+
+    notified, digests = [], []
+
+    class Handler(object):
+        name = 'test'
+
+        def notify(self, level, alert, value, **kwargs):
+            notified.append((level, kwargs['target']))
+
+        def notify_many(self, events):
+            digests.append([(e.level, e.target) for e in events])
+
+    handler = Handler()
+    reactor.options.update(digest=True, notify_queue_size=0)
+    reactor.handlers = {'critical': set([handler]), 'warning': set([handler]), 'normal': set()}
+    alert = BaseAlert.get(reactor, name='Test', query='*', rules=["normal: == 0"])
+    other = BaseAlert.get(reactor, name='Other', query='*', rules=["normal: == 0"])
+
+    @gen.coroutine
+    def run():
+        reactor.notify('critical', alert, 1, target='a')
+        reactor.notify('warning', alert, 1, target='b')
+        reactor.notify('normal', alert, 0, target='c')
+        reactor.notify('critical', other, 1, target='d')
+        assert not notified and not digests
+        yield gen.moment
+
+    ioloop.IOLoop.current().run_sync(run)
+    assert digests == [[('critical', 'a'), ('warning', 'b')]]
+    assert notified == [('critical', 'd')]
+
+    from graphite_beacon.events import Event
+    from graphite_beacon.handlers.log import LogHandler
+    log = LogHandler(reactor)
+    events = [Event('warning', alert, 1, 'b', 'graphite', alert.rules[0]),
+              Event('critical', alert, 1, 'a', 'graphite', alert.rules[0])]
+    assert log.get_level(events) == 'critical'
+    short = log.get_digest(events)
+    assert 'CRITICAL <Test> 2 targets changed' in short
+    assert 'b warning' in short
+
+
+def test_pagerduty_digest(reactor):
+    import json
+    from tornado import concurrent, httpclient, ioloop
+    from graphite_beacon.alerts import BaseAlert
+    from graphite_beacon.events import Event
+    from graphite_beacon.handlers.pagerduty import PagerdutyHandler
+
+    reactor.options['pagerduty'] = {'subdomain': 'beacon', 'apitoken': 'token',
+                                    'service_key': 'key'}
+    alert = BaseAlert.get(reactor, name='Test', query='*', rules=["critical: > 5"])
+    rule = alert.rules[0]
+    events = [Event('critical', alert, 10, 'a', 'graphite', rule),
+              Event('critical', alert, 20, 'b', 'graphite', rule),
+              Event('normal', alert, 1, 'c', 'graphite', rule)]
+
+    def fetch(url, body=None, **kwargs):
+        future = concurrent.Future()
+        future.set_result(mock.Mock())
+        return future
+
+    with mock.patch.object(httpclient.AsyncHTTPClient, 'fetch', side_effect=fetch) as fetch:
+        handler = PagerdutyHandler(reactor)
+        ioloop.IOLoop.current().run_sync(lambda: handler.notify_many(events))
+
+    # One request per incident: the targets of a rule share its incident key
+    requests = sorted((json.loads(c[1]['body']) for c in fetch.call_args_list),
+                      key=lambda data: data['event_type'])
+    assert [(r['event_type'], r['incident_key']) for r in requests] == [
+        ('resolve', rule['raw']), ('trigger', rule['raw'])]
+    assert '2 targets changed' in requests[1]['description']
+
+
+def test_event_render(reactor):
+    from graphite_beacon.alerts import BaseAlert
+    from graphite_beacon.events import Event
+    from graphite_beacon.handlers.log import LogHandler
+    from graphite_beacon.handlers.smtp import SMTPHandler
+    from graphite_beacon.template import TEMPLATES
+
+    alert = BaseAlert.get(reactor, name='Test', query='*', rules=["warning: > 3"])
+    reactor.options['smtp'] = {'to': 'user@com.com', 'graphite_url': 'http://graphite.myhost.com'}
+    log, smtp = LogHandler(reactor), SMTPHandler(reactor)
+    event = Event('warning', alert, 5, 'node', 'graphite', alert.rules[0])
+
+    short = TEMPLATES['graphite']['short']
+    with mock.patch.object(short, 'generate', wraps=short.generate) as generate:
+        args, kwargs = event.args
+        assert log.get_short(*args, **kwargs) == smtp.get_short(*args, **kwargs)
+        assert generate.call_count == 1
+
+    message = smtp.get_message(*args, **kwargs)
+    assert 'graphite.myhost.com' in message._payload[1].as_string()
+    assert ('html', ('graphite_url', 'http://graphite.myhost.com')) in event.rendered
+
+    # The history and the tested values are taken when the event is created
+    alert = BaseAlert.get(reactor, name='Test', query='*', rules=["warning: > historical"])
+    alert.history['node'] += [1, 1, 1, 1]
+    with mock.patch.object(reactor.dispatcher, 'fan_out') as fan_out:
+        alert.check([(2, 'node')])
+        alert.check([(8, 'node')])
+    event = fan_out.call_args_list[0][1]['event']
+    assert (event.history, event.tested) == ([1, 1, 1, 1], [1])
+    assert 'Tested value:</b> %s' % alert.convert(1) in event.render('text', reactor)
+
+
+def test_hash_ring():
+    from graphite_beacon.shard import HashRing
+
+    names = ['alert%d' % num for num in range(1000)]
+    ring = HashRing(4)
+    nodes = [ring.get(name) for name in names]
+    assert all(150 < nodes.count(node) < 350 for node in range(4))
+
+    # Adding a node moves only the names it takes over
+    moved = [name for name, node in zip(names, nodes) if HashRing(5).get(name) != node]
+    assert all(HashRing(5).get(name) == 4 for name in moved)
+    assert len(moved) < 350
+
+
+def test_shard(reactor):
+    import os
+    from tornado import ioloop
+    from graphite_beacon.core import Reactor
+    from graphite_beacon.shard import Shard, Supervisor, Upstream
+
+    alerts = [{'name': 'alert%d' % num, 'query': '*', 'rules': ['warning: > 3']}
+              for num in range(10)]
+    worker = Reactor(shard=Shard(0, 2), alerts=alerts, history_size='40m')
+    owned = set(alert for alert in worker.alerts if worker.shard.owns(alert.name))
+    assert 0 < len(owned) < 10
+    assert set(worker.scheduler.jobs) == owned
+    assert not any(worker.handlers.values())
+    worker.scheduler.stop()
+
+    supervisor = Supervisor(2)
+    supervisor.reactor = Reactor(shard=Shard(None, 2), alerts=alerts, history_size='40m')
+    assert not supervisor.reactor.scheduler.jobs
+    assert supervisor.reactor.handlers['critical']
+
+    rfd, wfd = os.pipe()
+    worker.upstream = Upstream(worker, wfd)
+    alert = sorted(owned, key=lambda a: a.name)[0]
+    alert.history['a'] += [1, 1, 1, 1]
+    alert.history['b'] += [1, 2, 5, 4]
+    alert.check([(7, 'a'), (9, 'b')])
+    ioloop.IOLoop.current().run_sync(lambda: None)
+
+    # The events of a check come in one line, with the values the worker has tested
+    lines = os.read(rfd, 4096).splitlines()
+    assert len(lines) == 1
+    with mock.patch.object(supervisor.reactor, 'publish') as publish:
+        supervisor.index_alerts()
+        supervisor.route(lines[0])
+    events = [call[0][0] for call in publish.call_args_list]
+    assert [(e.level, e.alert.name, e.target, e.value) for e in events] == [
+        ('warning', alert.name, 'a', 7), ('warning', alert.name, 'b', 9)]
+    assert events[0].rule is events[0].alert.rules[0]
+    assert (events[1].history, events[1].tested) == ([1, 2, 5, 4], [3])
+    assert not events[1].alert.history
+    worker.upstream.stream.set_close_callback(None)
+    worker.upstream.stream.close()
+    os.close(rfd)
+
+
+def test_target_store():
+    from graphite_beacon.store import HistoryMap, StateMap, TargetStore
+
+    store = TargetStore(3)
+    history = HistoryMap(store)
+    state = StateMap(store, {None: 'normal'})
+
+    history['a'] += [1, 2, 3, 4]
+    assert list(history['a']) == [2, 3, 4]
+    assert (history['a'].sum, history['a'].average) == (9, 3)
+    assert history['a'][:2] == [2, 3] and history['a'][-1] == 4
+    assert not history['b'] and 'b' in history
+    state['b'] = 'warning'
+    state['c'] = 'critical'
+    assert state == {None: 'normal', 'b': 'warning', 'c': 'critical'}
+    assert 'a' not in state and state.get('a') is None
+
+    state.fill('normal')
+    assert state == {None: 'normal', 'b': 'normal', 'c': 'normal'}
+
+    # A slot is freed when the target has neither a level nor a history
+    assert history.pop('a') == [2, 3, 4]
+    assert 'a' not in history
+    del state['c']
+    assert 'c' not in history
+    slots = len(store.targets)
+    history['d'].append(5)
+    assert len(store.targets) == slots
+    assert list(history['d']) == [5]
+    assert history == {'b': [], 'd': [5]}
+
+
+def test_evict_targets(reactor):
+    from graphite_beacon.alerts import BaseAlert
+
+    alert = BaseAlert.get(
+        reactor, name='Test', query='*', rules=["critical: > 3"], target_ttl='1minute',
+        target_disappeared='normal', max_targets=3)
+
+    with mock.patch('time.time', return_value=1000):
+        alert.check([(5, 'a'), (1, 'b')])
+    assert set(alert.last_seen) == set(['a', 'b'])
+
+    with mock.patch.object(reactor, 'notify') as notify, \
+            mock.patch('time.time', return_value=1070):
+        alert.check([(1, 'c')])
+        # Disappearances are reported whatever the targets' levels
+        assert sorted(
+            (c[0][0], c[1]['target'], c[1]['ntype']) for c in notify.call_args_list) == [
+            ('normal', 'a', 'disappeared'), ('normal', 'b', 'disappeared')]
+    assert set(alert.history) == set(alert.last_seen) == set(['c'])
+    assert 'a' not in alert.state
+
+    # New targets over the cap are ignored, the tracked ones are never dropped for them
+    with mock.patch('time.time', return_value=1080):
+        alert.check([(1, 'd'), (5, 'e'), (1, 'f')])
+    assert set(alert.last_seen) == set(alert.history) == set(['c', 'd', 'e'])
+
+    with mock.patch.object(reactor, 'notify') as notify, \
+            mock.patch('time.time', return_value=1090):
+        alert.check([(1, 'd'), (5, 'e'), (9, 'f')])
+        assert not notify.called
+    assert set(alert.last_seen) == set(['c', 'd', 'e'])
+
+    # Room freed by an expired target is taken by a new one
+    with mock.patch('time.time', return_value=1140):
+        alert.check([(1, 'd'), (5, 'e'), (9, 'f')])
+    assert set(alert.last_seen) == set(['d', 'e', 'f'])
+
+
+def test_target_disappeared_level(reactor):
+    from graphite_beacon.alerts import BaseAlert
+
+    alert = BaseAlert.get(
+        reactor, name='Test', query='*', rules=["warning: > 3"], target_ttl='1minute',
+        target_disappeared='warning')
+
+    with mock.patch('time.time', return_value=1000):
+        alert.check([(5, 'a')])
+    assert alert.state['a'] == 'warning'
+
+    # The target is already at the disappearance level, it is reported anyway
+    with mock.patch.object(reactor, 'notify') as notify, \
+            mock.patch('time.time', return_value=1070):
+        alert.check([(1, 'b')])
+        assert [(c[0][0], c[1]['target'], c[1]['ntype']) for c in notify.call_args_list] == [
+            ('warning', 'a', 'disappeared')]
+    assert 'a' not in alert.state
+
+
+def test_reload_alerts(reactor):
+    alerts = [
+        {'name': 'kept', 'query': 'kept.*', 'rules': ['warning: > 3']},
+        {'name': 'changed', 'query': 'changed.*', 'rules': ['warning: > 3']},
+        {'name': 'removed', 'query': 'removed.*', 'rules': ['warning: > 3']},
+    ]
+    reactor.reinit(alerts=alerts)
+    alerts = dict((alert.name, alert) for alert in reactor.alerts)
+    alerts['kept'].history['a'].append(1)
+    alerts['kept'].state['a'] = 'warning'
+
+    reactor.reinit(alerts=[
+        {'name': 'kept', 'query': 'kept.*', 'rules': ['warning: > 3']},
+        {'name': 'changed', 'query': 'changed.*', 'rules': ['warning: > 5']},
+        {'name': 'added', 'query': 'added.*', 'rules': ['warning: > 3']},
+    ])
+    reloaded = dict((alert.name, alert) for alert in reactor.alerts)
+    assert sorted(reloaded) == ['added', 'changed', 'kept']
+    assert reloaded['kept'] is alerts['kept']
+    assert reloaded['kept'].state['a'] == 'warning'
+    assert reloaded['changed'] is not alerts['changed']
+    assert set(reactor.scheduler.jobs) == set(reloaded.values())
+    assert reactor.scheduler.jobs[reloaded['changed']][2] is reloaded['changed']
+
+    # Changed defaults rebuild the alerts
+    reactor.reinit(interval='1minute')
+    assert not set(map(id, reactor.alerts)) & set(map(id, reloaded.values()))
+    reactor.scheduler.stop()
+
+
+def test_snapshot(reactor, tmpdir):
+    from graphite_beacon.alerts import BaseAlert
+    from graphite_beacon.snapshot import Snapshot
+
+    path = str(tmpdir.join('snapshot'))
+    alert = BaseAlert.get(reactor, name='Test', query='*', rules=["warning: > 3"])
+    alert.history['a'].extend([1, 2, 3.5])
+    alert.history['b'].append(4)
+    alert.state['a'] = 'warning'
+    alert.state['loading'] = 'critical'
+    reactor.alerts = set([alert])
+
+    snapshot = Snapshot(reactor)
+    assert snapshot.configure(path)
+    snapshot.save()
+    snapshot.writer.join()
+    snapshot.stop()
+
+    restored = BaseAlert.get(reactor, name='Test', query='*', rules=["warning: > 3"])
+    other = BaseAlert.get(reactor, name='Test', query='other.*', rules=["warning: > 3"])
+    reactor.alerts = set([restored, other])
+    snapshot = Snapshot(reactor)
+    snapshot.configure(path)
+    snapshot.restore()
+    snapshot.stop()
+
+    assert list(restored.history['a']) == [1, 2, 3.5]
+    assert restored.history['a'].average == 6.5 / 3
+    assert list(restored.history['b']) == [4]
+    assert restored.state['a'] == 'warning'
+    assert restored.state['loading'] == 'normal'
+    assert not other.history
+
+    # An alert which has already started merges the snapshot into its targets
+    restored.history['b'].append(5)
+    snapshot.save(wait=True)
+    running = BaseAlert.get(reactor, name='Test', query='*', rules=["warning: > 3"])
+    running.history['c'].append(7)
+    reactor.alerts = set([running])
+    snapshot.restore()
+    assert list(running.history['b']) == [4, 5]
+    assert list(running.history['c']) == [7]
+    assert running.state['a'] == 'warning'
+
+
+def test_spool(reactor, tmpdir):
+    import json
+    from tornado import gen, ioloop
+    from graphite_beacon.alerts import BaseAlert
+    from graphite_beacon.spool import Spool
+
+    results = [ValueError('down'), None]
+
+    class Handler(object):
+        name = 'test'
+
+        def notify(self, level, alert, value, **kwargs):
+            result = results.pop(0)
+            if result:
+                raise result
+
+    path = str(tmpdir.join('spool'))
+    handler = Handler()
+    alert = BaseAlert.get(reactor, name='Test', query='*', rules=["warning: > 3"])
+    reactor.alerts = set([alert])
+    reactor.handlers = {'warning': set([handler]), 'critical': set(), 'normal': set()}
+    reactor.options.update(
+        notify_queue_size=0, spool_backoff='10ms', spool_fsync='10ms', spool_retries=1)
+    spool = reactor.spool
+    assert spool.open(path)
+
+    @gen.coroutine
+    def run():
+        reactor.notify('warning', alert, 5, target='a', rule=alert.rules[0])
+        assert len(spool.entries) == 1
+        while spool.entries:
+            yield gen.sleep(.01)
+        yield gen.sleep(.02)
+
+    ioloop.IOLoop.current().run_sync(run)
+    assert not results
+    with open(path) as log:
+        records = [json.loads(line) for line in log]
+    assert [r['op'] for r in records] == ['add', 'ack']
+    assert records[0]['event']['rule'] == 'warning: > 3'
+
+    # Pending deliveries are replayed from the log
+    with open(path, 'a') as log:
+        log.write(json.dumps(dict(records[0], id=2)) + '\n')
+    delivered = []
+    handler.notify = lambda level, alert, value, **kwargs: delivered.append(
+        (level, alert, value, kwargs['target'], kwargs['rule']))
+    spool = reactor.spool = Spool(reactor)
+    assert spool.open(path)
+    assert list(spool.entries) == [2]
+    spool.replay()
+    assert delivered == [('warning', alert, 5, 'a', alert.rules[0])]
+    assert not spool.entries
+    spool.close()
+
+
+def test_cli(reactor, tmpdir):
+    import json
+    from tornado import gen, ioloop
+    from graphite_beacon.handlers.cli import CliHandler
+
+    out = tmpdir.join('out')
+    reactor.options['cli'] = {
+        'command': 'echo ${level} ${target} >> %s' % out, 'pool_size': 1, 'timeout': '200ms'}
+    handler = CliHandler(reactor)
+
+    @gen.coroutine
+    def wait():
+        while handler.running or handler.queue or handler.batch:
+            yield gen.sleep(.01)
+
+    handler.notify('critical', 'Test (1minute)', 1, target='a')
+    handler.notify('normal', 'Test (1minute)', 0, target='b')
+    assert len(handler.running) == 1 and len(handler.queue) == 1
+    ioloop.IOLoop.current().run_sync(wait, timeout=5)
+    assert out.read().split('\n') == ['critical a', 'normal b', '']
+
+    # Timed out commands are killed
+    handler.run('sleep 10')
+    start = ioloop.IOLoop.current().time()
+    ioloop.IOLoop.current().run_sync(wait, timeout=5)
+    assert ioloop.IOLoop.current().time() - start < 5
+
+    # Events are batched into one invocation of the batch command
+    batch = tmpdir.join('batch')
+    reactor.options['cli'] = {'batch_command': 'cat >> %s; echo >> %s' % (batch, batch)}
+    handler = CliHandler(reactor)
+    handler.notify('critical', 'Test', 1, target='a')
+    handler.notify('warning', 'Test', 2, target='b')
+    assert len(handler.batch) == 2
+    ioloop.IOLoop.current().run_sync(wait, timeout=5)
+    lines = batch.read().split('\n')
+    assert [json.loads(line)['target'] for line in lines[:2]] == ['a', 'b']
+    assert lines[2:] == ['', '']
+
+
+def test_telegram(reactor):
+    import json
+    from tornado import concurrent, ioloop
+
+    requests = []
+
+    def fetch(url, body=None, **kwargs):
+        future = concurrent.Future()
+        requests.append((url.rsplit('/', 1)[1], json.loads(body), future))
+        return future
+
+    def respond(future, data):
+        future.set_result(mock.Mock(body=json.dumps(data)))
+        ioloop.IOLoop.current().run_sync(lambda: None)
+
+    reactor.options['telegram'] = {'token': 'token', 'bot_ident': 'ident'}
+    with mock.patch('tornado.httpclient.AsyncHTTPClient') as client:
+        client.return_value.fetch.side_effect = fetch
+        from graphite_beacon.handlers.telegram import TelegramHandler
+        handler = TelegramHandler(reactor)
+
+    # One long-poll request in flight
+    assert [(m, b) for m, b, _ in requests] == [('getUpdates', {'timeout': 50})]
+    respond(requests[0][2], {'result': [
+        {'update_id': 5, 'message': {}},
+        {'update_id': 6, 'message': {
+            'text': '/activate ident', 'chat': {'id': 1}, 'message_id': 1}}]})
+    assert handler._chats == [1]
+    assert requests[1][0] == 'sendMessage'
+    assert len(requests) == 2
+
+    respond(requests[1][2], {'ok': True})
+    assert requests[2][:2] == ('getUpdates', {'timeout': 50, 'offset': 7})
+
+    # Notifications go to all the chats at once
+    handler._chats.append(2)
+    del requests[:]
+    sent = handler.send('message')
+    assert [(m, b['chat_id']) for m, b, _ in requests] == [
+        ('sendMessage', 1), ('sendMessage', 2)]
+
+    # A failed chat fails the delivery, so it can be retried
+    respond(requests[0][2], {'ok': True})
+    requests[1][2].set_exception(ValueError('Bad Gateway'))
+    ioloop.IOLoop.current().run_sync(lambda: None)
+    assert isinstance(sent.exception(), ValueError)
+
+    handler.stop()
+
+
+def test_slack(reactor):
+    import json
+    from tornado import concurrent, httpclient, ioloop
+    from graphite_beacon.alerts import BaseAlert
+    from graphite_beacon.handlers.slack import SlackHandler
+
+    requests = []
+
+    def fetch(url, **kwargs):
+        requests.append((url, kwargs))
+        if 'channels.list' in url:
+            body = {'ok': True, 'channels': [{'name': 'alerts', 'id': 'C01'}]}
+        elif 'files.upload' in url:
+            body = {'ok': True, 'file': {'url_private': 'https://files/graph.png'}}
+        else:
+            body = {'ok': True}
+        future = concurrent.Future()
+        future.set_result(mock.Mock(body=json.dumps(body).encode('utf-8')))
+        return future
+
+    reactor.options['slack'] = {'token': 'secret', 'channel': '#alerts'}
+    alert = BaseAlert.get(reactor, name='Test', query='*', rules=["critical: > 5"])
+
+    with mock.patch.object(httpclient.AsyncHTTPClient, 'fetch', side_effect=fetch):
+        slack = SlackHandler(reactor)
+        assert slack.channels == {'alerts': 'C01'}
+
+        ioloop.IOLoop.current().run_sync(lambda: slack.notify(
+            'critical', alert, 10, target='host', rule=alert.rules[0]))
+
+        # Unlisted channels reload the list once until the next refresh
+        for _ in range(3):
+            channel = ioloop.IOLoop.current().run_sync(lambda: slack.get_channel_id('@user'))
+            assert channel == '@user'
+        slack.stop()
+
+    assert [url for url, _ in requests].count('https://slack.com/api/channels.list') == 2
+    del requests[4:]
+
+    urls = [url for url, _ in requests]
+    assert urls[0] == 'https://slack.com/api/channels.list'
+    assert urls[1].startswith('http://localhost/render/')
+    assert urls[2].startswith('https://slack.com/api/files.upload?')
+    assert urls[3] == 'https://slack.com/api/chat.postMessage'
+    assert 'channel=C01' in requests[3][1]['body']
+    assert 'graph.png' in requests[3][1]['body']
+
+
+def test_slack_images(reactor):
+    from tornado import concurrent, httpclient
+    from graphite_beacon.alerts import BaseAlert
+    from graphite_beacon.handlers.slack import SlackHandler
+
+    reactor.options['slack'] = {'token': 'secret', 'image_burst': 3}
+    alert = BaseAlert.get(reactor, name='Test', query='hosts.*.cpu', rules=["critical: > 5"])
+
+    def post_image(url):
+        future = concurrent.Future()
+        future.set_result(url)
+        return future
+
+    with mock.patch.object(httpclient.AsyncHTTPClient, 'fetch'):
+        slack = SlackHandler(reactor)
+        slack.stop()
+
+    with mock.patch.object(slack, 'post_image', side_effect=post_image) as upload:
+        with mock.patch('time.time', return_value=600):
+            images = [slack.get_image(alert, 'hosts.%d.cpu' % num).result() for num in range(5)]
+            assert slack.get_image(alert, 'hosts.0.cpu').result() == images[4]
+
+        assert upload.call_count == 3
+        assert 'hosts.0.cpu' in images[0]
+        assert 'hosts.1.cpu' in images[1]
+        assert images[2] == images[3] == images[4]
+        assert 'hosts.%2A.cpu' in images[2]
+
+        # The next time bucket uploads graphs again
+        with mock.patch('time.time', return_value=660):
+            slack.get_image(alert, 'hosts.0.cpu')
+        assert upload.call_count == 4
+
+        # No caching with image_ttl = 0
+        slack.options['image_ttl'] = '0second'
+        slack.get_image(alert, 'hosts.0.cpu')
+        slack.get_image(alert, 'hosts.0.cpu')
+        assert upload.call_count == 6
+
+
+def test_smtp_pool(reactor):
+    from tornado import gen, ioloop
+    from graphite_beacon.alerts import BaseAlert
+    from graphite_beacon.handlers.smtp import SMTPHandler
+
+    reactor.options['smtp'] = {'to': 'user@com.com', 'pool_size': 1, 'max_messages': 2}
+    alert = BaseAlert.get(reactor, name='Test', query='*', rules=["critical: > 5"])
+    smtp = SMTPHandler(reactor)
+
+    @gen.coroutine
+    def run():
+        yield [smtp.notify('critical', alert, value, target='host', ntype='graphite',
+                           rule=alert.rules[0]) for value in (10, 20, 30)]
+
+    with mock.patch('graphite_beacon.handlers.smtp.SMTP') as SMTP:
+        ioloop.IOLoop.current().run_sync(run, timeout=5)
+        smtp.stop()
+
+    # Three messages over two sessions (max_messages = 2)
+    assert SMTP.call_count == 2
+    assert SMTP.return_value.connect.call_count == 2
+    assert SMTP.return_value.sendmail.call_count == 3
+
+
+def test_smtp_pool_idle():
+    import time
+    from datetime import timedelta
+    from tornado import gen, ioloop
+    from graphite_beacon.handlers.smtp import SMTPPool
+
+    pool = SMTPPool({'pool_size': 1, 'idle_timeout': '10ms', 'max_messages': 100})
+    smtp = mock.Mock()
+    # Closing an idle session takes a while
+    smtp.quit.side_effect = lambda: time.sleep(0.2)
+
+    @gen.coroutine
+    def send():
+        result = yield gen.with_timeout(
+            timedelta(seconds=1), pool.send('from@host', ['to@host'], 'message'))
+        raise gen.Return(result)
+
+    loop = ioloop.IOLoop.current()
+    with mock.patch.object(pool, 'connect', return_value=smtp):
+        loop.run_sync(send)
+        time.sleep(0.05)
+        # The idle worker is quitting, the message is sent by a new one
+        loop.run_sync(send)
+        pool.stop()
+
+    assert smtp.sendmail.call_count == 2